@@ -4,14 +4,17 @@
 
 import argparse
 import glob
+import hashlib
 import logging
 import multiprocessing as mp
 import os
 from pathlib import Path
 import pickle
+import queue
 import re
 import threading
 import time
+from types import SimpleNamespace
 import zlib
 
 import numpy as np
@@ -20,17 +23,24 @@ import torch
 
 import species_handlers
 from core import audio
+from core import cache
 from core import cfg
 from core import filters
 from core import frequency_db
+from core import manifest
+from core import labels as label_engine
+from core.labels import Label
 from core import util
-from model import main_model
+from model import ensemble
+
+PIPELINE_POLL_SECONDS = 0.1 # how often a blocked pipeline stage checks whether another stage failed
 
 class ClassInfo:
-    def __init__(self, name, code, ignore):
+    def __init__(self, name, code, ignore, index):
         self.name = name
         self.code = code
         self.ignore = ignore
+        self.index = index   # column in the score matrix
         self.max_frequency = 0
         self.is_bird = True
         self.reset()
@@ -38,19 +48,18 @@ class ClassInfo:
     def reset(self):
         self.ebird_frequency_too_low = False
         self.has_label = False
-        self.scores = []     # predictions (one per segment)
-        self.is_label = []   # True iff corresponding offset is a label
+        self.scores = None   # predictions (one per segment)
+        self.is_label = None # True iff corresponding offset is a label
 
-class Label:
-    def __init__(self, class_name, score, start_time, end_time):
-        self.class_name = class_name
-        self.score = score
-        self.start_time = start_time
-        self.end_time = end_time
+    # given the per-recording score matrix and label mask, both with shape (segments, classes),
+    # make scores and is_label views of this class's column, so updating them updates the matrix
+    def set_scores(self, scores, is_label):
+        self.scores = scores[:, self.index]
+        self.is_label = is_label[:, self.index]
 
 class Analyzer:
     def __init__(self, input_path, output_path, start_time, end_time, date_str, latitude, longitude, region,
-                 filelist, debug_mode, merge, overlap, device, thread_num=1, embed=False):
+                 filelist, debug_mode, merge, overlap, device, thread_num=1, embed=False, models=None):
         self.input_path = input_path.strip()
         self.output_path = output_path.strip()
         self.start_seconds = self._get_seconds_from_time_string(start_time)
@@ -65,18 +74,31 @@ class Analyzer:
         self.thread_num = thread_num
         self.embed = embed
         self.device = device
+        self.loaded_models = models # models loaded by the parent process, or None to load them in run()
         self.frequencies = {}
         self.issued_skip_files_warning = False
         self.have_rarities_directory = False
 
+        # when filters are enabled, the unfiltered spectrograms (if do_unfiltered) and the filtered versions
+        # are all passed to the models in one batch, so keep a stack of per-row multipliers, with a row of
+        # ones for the unfiltered case; filter_variants is None when no filters are enabled
+        filter_variants = []
         if cfg.infer.do_lpf:
-            self.low_pass_filter = filters.low_pass_filter(cfg.infer.lpf_start_freq, cfg.infer.lpf_end_freq, cfg.infer.lpf_damp)
+            filter_variants.append(filters.low_pass_filter(cfg.infer.lpf_start_freq, cfg.infer.lpf_end_freq, cfg.infer.lpf_damp))
 
         if cfg.infer.do_hpf:
-            self.high_pass_filter = filters.high_pass_filter(cfg.infer.hpf_start_freq, cfg.infer.hpf_end_freq, cfg.infer.hpf_damp)
+            filter_variants.append(filters.high_pass_filter(cfg.infer.hpf_start_freq, cfg.infer.hpf_end_freq, cfg.infer.hpf_damp))
 
         if cfg.infer.do_bpf:
-            self.band_pass_filter = filters.band_pass_filter(cfg.infer.bpf_start_freq, cfg.infer.bpf_end_freq, cfg.infer.bpf_damp)
+            filter_variants.append(filters.band_pass_filter(cfg.infer.bpf_start_freq, cfg.infer.bpf_end_freq, cfg.infer.bpf_damp))
+
+        if len(filter_variants) == 0:
+            self.filter_variants = None
+        else:
+            if cfg.infer.do_unfiltered:
+                filter_variants.insert(0, np.ones(cfg.audio.spec_height))
+
+            self.filter_variants = np.array(filter_variants, dtype=np.float32)
 
         if cfg.infer.min_score == 0:
             self.merge_labels = False # merging all labels >= min_score makes no sense in this case
@@ -102,6 +124,10 @@ class Analyzer:
         # save labels here if they were excluded because of location/date processing
         self.rarities_output_path = os.path.join(self.output_path, 'rarities')
 
+        # record processed recordings here, so an interrupted run can be resumed
+        self.manifest_path = os.path.join(self.output_path, 'HawkEars_manifest.db')
+        self.settings_key = self._get_settings_key()
+
     @staticmethod
     def _get_file_list(input_path):
         if os.path.isdir(input_path):
@@ -112,6 +138,173 @@ class Analyzer:
             logging.error(f"Error: {input_path} is not a directory or an audio file")
             quit()
 
+    # return the paths of the main ensemble models and the low-band model for the selected backend
+    @staticmethod
+    def _get_model_paths():
+        if cfg.infer.backend == 'onnx':
+            return sorted(glob.glob(os.path.join(cfg.misc.main_onnx_folder, "*.onnx"))), cfg.misc.low_band_onnx_path
+        elif cfg.infer.backend == 'int8':
+            # the low band model is small, so it isn't quantized
+            return sorted(glob.glob(os.path.join(cfg.misc.main_int8_folder, "*.onnx"))), cfg.misc.low_band_onnx_path
+        elif cfg.infer.backend == 'script':
+            return sorted(glob.glob(os.path.join(cfg.misc.main_script_folder, "*.pt"))), cfg.misc.low_band_script_path
+        else:
+            return sorted(glob.glob(os.path.join(cfg.misc.main_ckpt_folder, "*.ckpt"))), cfg.misc.low_band_ckpt_path
+
+    # return the set of resources needed by species handlers for the given class names and codes (see species_handlers.py)
+    @staticmethod
+    def _get_handler_resources(class_names, class_codes):
+        ignore_list = util.get_file_lines(cfg.misc.ignore_file)
+        class_codes = [code for name, code in zip(class_names, class_codes) if name not in ignore_list]
+        return species_handlers.Species_Handlers('cpu').get_resources(class_codes)
+
+    # load the main ensemble, plus the low-band model if a species handler needs it, and optional embedding model
+    @staticmethod
+    def _load_models(device, embed):
+        model_paths, low_band_path = Analyzer._get_model_paths()
+        if len(model_paths) == 0:
+            logging.error(f"Error: no {cfg.infer.backend} models found")
+            quit()
+
+        models = SimpleNamespace(main=[], low_band=None, embed=None)
+        if cfg.infer.backend in ['onnx', 'int8']:
+            from model import onnx_model # optional dependency, so only import it when needed
+
+            # by default, divide the cores among the analyzer threads, since each runs its own models
+            num_threads = cfg.infer.onnx_threads if cfg.infer.onnx_threads > 0 else max(1, (os.cpu_count() or 1) // cfg.infer.num_threads)
+            load_model = lambda path: onnx_model.OnnxModel(path, num_threads)
+        elif cfg.infer.backend == 'script':
+            from model import script_model
+
+            load_model = lambda path: script_model.ScriptModel(path, device)
+        else:
+            # importing main_model imports PyTorch Lightning and timm, which is slow, so only do it when needed
+            from model import main_model
+
+            load_model = lambda path: main_model.MainModel.load_from_checkpoint(path, map_location=torch.device(device)).eval() # inference mode
+
+        for model_path in model_paths:
+            models.main.append(load_model(model_path))
+
+        # the low band model is only used by the Ruffed Grouse handler, so skip it if RUGR is ignored
+        if species_handlers.LOW_BAND in Analyzer._get_handler_resources(models.main[0].train_class_names, models.main[0].train_class_codes):
+            models.low_band = load_model(low_band_path)
+
+        if embed:
+            from model import main_model
+            models.embed = main_model.MainModel.load_from_checkpoint(cfg.misc.search_ckpt_path, map_location=torch.device(device))
+            models.embed.eval()
+
+        return models
+
+    # return a key that identifies the checkpoints and all settings that affect the output;
+    # checkpoints are identified by size and modification time, which is much faster than hashing them
+    def _get_settings_key(self):
+        model_paths, low_band_path = Analyzer._get_model_paths()
+        checkpoints = model_paths + [low_band_path]
+        if self.embed:
+            checkpoints.append(cfg.misc.search_ckpt_path)
+
+        settings = {}
+        for path in sorted(checkpoints):
+            if os.path.exists(path):
+                stat = os.stat(path)
+                settings[path] = (stat.st_size, stat.st_mtime)
+
+        # settings that only affect speed or memory use are excluded
+        ignore = ['num_threads', 'file_order', 'share_models', 'pipeline_depth', 'block_size', 'top_n', 'cache_path', 'cache_max_gb', 'onnx_threads']
+        for section in ['audio', 'infer']:
+            section_cfg = getattr(cfg, section)
+            for name in dir(section_cfg):
+                if not name.startswith('_') and name not in ignore:
+                    settings[f'{section}.{name}'] = getattr(section_cfg, name)
+
+        for name in ['start_seconds', 'end_seconds', 'date_str', 'latitude', 'longitude', 'region', 'filelist', 'merge_labels', 'overlap', 'embed']:
+            settings[name] = getattr(self, name)
+
+        return hashlib.sha1(repr(sorted(settings.items())).encode()).hexdigest()
+
+    # return a key for the checkpoint contents and the settings that affect the saved scores,
+    # which is combined with a hash of each recording's contents to get its cache key
+    def _get_cache_settings_key(self):
+        model_paths, low_band_path = Analyzer._get_model_paths()
+        checkpoints = model_paths + [low_band_path]
+        settings = {}
+        for path in sorted(checkpoints):
+            if os.path.exists(path): # the low band model is optional if Ruffed Grouse is ignored
+                settings[os.path.basename(path)] = cache.hash_file(path)
+
+        for name in dir(cfg.audio):
+            if not name.startswith('_'):
+                settings[f'audio.{name}'] = getattr(cfg.audio, name)
+
+        for name in ['audio_exponent', 'do_unfiltered', 'do_lpf', 'lpf_damp', 'lpf_start_freq', 'lpf_end_freq', 'do_hpf', 'hpf_damp',
+                     'hpf_start_freq', 'hpf_end_freq', 'do_bpf', 'bpf_damp', 'bpf_start_freq', 'bpf_end_freq', 'stream', 'spec_from_blocks',
+                     'prescreen', 'prescreen_threshold', 'cascade', 'cascade_fraction', 'adaptive_overlap', 'adaptive_fraction',
+                     'sliding_window', 'strip_seconds']:
+            settings[f'infer.{name}'] = getattr(cfg.infer, name)
+
+        if cfg.infer.cascade or cfg.infer.adaptive_overlap:
+            # the cascade and adaptive overlap thresholds depend on these
+            settings['infer.min_score'] = cfg.infer.min_score
+            settings['infer.score_exponent'] = cfg.infer.score_exponent
+
+        if cfg.infer.do_lpf or cfg.infer.do_hpf or cfg.infer.do_bpf or cfg.infer.cascade or cfg.infer.adaptive_overlap:
+            # filtered scores are only merged for classes that aren't ignored, and the cascade and adaptive overlap
+            # only check those classes, so the saved scores depend on the ignore list
+            settings['ignored_classes'] = [class_info.name for class_info, ignore in zip(self.class_infos, self.ignore_mask) if ignore]
+
+        for name in ['start_seconds', 'end_seconds', 'overlap']:
+            settings[name] = getattr(self, name)
+
+        return hashlib.sha256(repr(sorted(settings.items())).encode()).hexdigest()
+
+    # return the recordings in file_list that weren't processed already with the same checkpoints and settings
+    def _get_pending_files(self, file_list):
+        if not os.path.exists(self.manifest_path):
+            return file_list
+
+        run_manifest = manifest.Manifest(self.manifest_path, self.settings_key)
+        pending = run_manifest.get_pending(file_list)
+        run_manifest.close()
+
+        logging.info(f"Resuming with {len(pending)} of {len(file_list)} recordings")
+        return pending
+
+    # move model weights to shared memory, so analyzer processes can use them without each having a copy
+    @staticmethod
+    def _share_models(models):
+        for model in models.main + [models.low_band, models.embed]:
+            if model is not None:
+                model.share_memory()
+
+    # sort files so the longest ones are processed first, which balances the load across threads;
+    # order is 'size' (file size), 'duration' (from the audio header) or 'name' (no change)
+    @staticmethod
+    def _order_file_list(file_list, order):
+        if order == 'duration':
+            durations = [audio.get_duration(file_path) for file_path in file_list]
+            if None not in durations:
+                return [file_path for _, file_path in sorted(zip(durations, file_list), reverse=True)]
+
+            logging.info("Unable to read duration of some files, so ordering them by size instead")
+            order = 'size'
+
+        if order == 'size':
+            return sorted(file_list, key=os.path.getsize, reverse=True)
+
+        return file_list
+
+    # yield file paths from a queue that is shared by all threads, until a None entry is found
+    @staticmethod
+    def _get_queued_files(file_queue):
+        while True:
+            file_path = file_queue.get()
+            if file_path is None:
+                break
+
+            yield file_path
+
     # return week number in the range [1, 48] as used by eBird barcharts, i.e. 4 weeks per month
     @staticmethod
     def _get_week_num_from_date_str(date_str):
@@ -256,102 +449,56 @@ class Analyzer:
                     class_info.frequency[week_num] = frequency[week_num]
 
     # get class names and codes from the model, which gets them from the checkpoint
-    def _get_class_infos(self):
-        class_names = self.models[0].train_class_names
-        class_codes = self.models[0].train_class_codes
+    def _get_class_infos(self, class_names, class_codes):
         ignore_list = util.get_file_lines(cfg.misc.ignore_file)
 
         class_infos = []
         for i, class_name in enumerate(class_names):
-            class_infos.append(ClassInfo(class_name, class_codes[i], class_name in ignore_list))
+            class_infos.append(ClassInfo(class_name, class_codes[i], class_name in ignore_list, i))
 
         return class_infos
 
-    # return the average prediction of all models in the ensemble
+    # return the average prediction of all models in the ensemble,
+    # with shape (variants, spectrograms, classes), where variants are as in self.filter_variants
     def _call_models(self, specs):
-        # get predictions for each model
-        predictions = []
-        for model in self.models:
-            model.to(self.device)
-            predictions.append(model.get_predictions(specs, self.device, use_softmax=False))
-
-        # calculate and return the average across models
-        avg_pred = None
-        for pred in predictions:
-            if avg_pred is None:
-                avg_pred = pred
-            else:
-                avg_pred += pred
-
-        avg_pred /= len(predictions)
-        return avg_pred ** cfg.infer.score_exponent
-
-    # get predictions using a low-pass, high-pass or band-pass filter,
-    # and then set each score to the max of the filtered and unfiltered score
-    def _apply_filter(self, original_specs, filter):
-        specs = original_specs.copy()
-        for i, spec in enumerate(specs):
-            spec = spec.reshape((cfg.audio.spec_height, cfg.audio.spec_width))
-            specs[i] = (spec.T * filter).T
-
-        predictions = self._call_models(specs)
-        for i in range(len(specs)):
-            for j in range(len(self.class_infos)):
-                if self.class_infos[j].ignore:
-                    continue
-
-                self.class_infos[j].scores[i] = max(self.class_infos[j].scores[i], predictions[i][j])
-                if (self.class_infos[j].scores[i] >= cfg.infer.min_score):
-                    self.class_infos[j].has_label = True
-
-    def _get_predictions(self, signal, rate):
-        # if needed, pad the signal with zeros to get the last spectrogram
-        total_seconds = signal.shape[0] / rate
-        last_segment_len = total_seconds - cfg.audio.segment_len * (total_seconds // cfg.audio.segment_len)
-        if last_segment_len > 0.5:
-            # more than 1/2 a second at the end, so we'd better analyze it
-            pad_amount = int(rate * (cfg.audio.segment_len - last_segment_len)) + 1
-            signal = np.pad(signal, (0, pad_amount), 'constant', constant_values=(0, 0))
-
-        start_seconds = 0 if self.start_seconds is None else self.start_seconds
-        max_end_seconds = max(0, (signal.shape[0] / rate) - cfg.audio.segment_len)
-        end_seconds = max_end_seconds if self.end_seconds is None else self.end_seconds
+        if self.filter_variants is None:
+            predictions = self.ensemble.get_predictions(specs)[np.newaxis]
+        else:
+            predictions = self.ensemble.get_predictions(specs, self.filter_variants)
 
-        specs = self._get_specs(start_seconds, end_seconds)
-        logging.debug(f"Analyzing from {start_seconds} to {end_seconds} seconds")
-        logging.debug(f"Retrieved {len(specs)} spectrograms")
+        return predictions
 
-        if cfg.infer.do_unfiltered:
+    # return the (segments, classes) score matrix for the given spectrograms, before score_exponent is applied
+    def _get_scores(self, specs):
+        scores = np.zeros((len(specs), len(self.class_infos)), dtype=np.float32)
+        filtered = None
+        if cfg.infer.do_unfiltered or self.filter_variants is not None:
             predictions = self._call_models(specs)
+            if cfg.infer.do_unfiltered:
+                scores = predictions[0]
+                filtered = predictions[1:]
 
-            if self.debug_mode:
-                self._log_predictions(predictions)
-
-        # populate class_infos with predictions using unfiltered spectrograms
-        for i in range(len(self.offsets)):
-            for j in range(len(self.class_infos)):
-                if cfg.infer.do_unfiltered:
-                    self.class_infos[j].scores.append(predictions[i][j])
-                else:
-                    self.class_infos[j].scores.append(0)
+                if self.debug_mode:
+                    self._log_predictions(scores ** cfg.infer.score_exponent)
+            else:
+                filtered = predictions
 
-                self.class_infos[j].is_label.append(False)
-                if (self.class_infos[j].scores[-1] >= cfg.infer.min_score):
-                    self.class_infos[j].has_label = True
+        # with low-pass, high-pass or band-pass filters, set each score to the max of the filtered
+        # and unfiltered scores, except for ignored classes
+        if filtered is not None and len(filtered) > 0:
+            scores = np.where(self.ignore_mask, scores, np.maximum(scores, filtered.max(axis=0)))
 
-        # optionally process low-pass, high-pass and band-pass filters
-        if cfg.infer.do_lpf:
-            self._apply_filter(specs, self.low_pass_filter)
+        return scores
 
-        if cfg.infer.do_hpf:
-            self._apply_filter(specs, self.high_pass_filter)
-
-        if cfg.infer.do_bpf:
-            self._apply_filter(specs, self.band_pass_filter)
-
-        # optionally generate embeddings
-        if self.embed:
-            self.embeddings = self.embed_model.get_embeddings(specs, self.device)
+    # keep the scores in a (segments, classes) matrix, with a mask of the same shape for labels,
+    # and point each class_info at its column
+    def _set_scores(self, scores):
+        self.scores = scores
+        self.is_label = np.zeros(scores.shape, dtype=bool)
+        has_label = (scores >= cfg.infer.min_score).any(axis=0)
+        for class_info in self.class_infos:
+            class_info.set_scores(self.scores, self.is_label)
+            class_info.has_label = bool(has_label[class_info.index])
 
     def _get_seconds_from_time_string(self, time_str):
         time_str = time_str.strip()
@@ -369,23 +516,249 @@ class Analyzer:
         seconds += float(tokens[-1])
         return seconds
 
-    # get the list of spectrograms
-    def _get_specs(self, start_seconds, end_seconds):
-        increment = max(0.5, cfg.audio.segment_len - self.overlap)
-        self.offsets = np.arange(start_seconds, end_seconds + 1.0, increment).tolist()
-        self.raw_spectrograms = [0 for i in range(len(self.offsets))]
-        specs = self.audio.get_spectrograms(self.offsets, segment_len=cfg.audio.segment_len, raw_spectrograms=self.raw_spectrograms)
+    # get the spectrograms for a work item, i.e. a decoded recording or a window of one, and store them in the item
+    def _get_specs(self, item):
+        if item.cached is not None:
+            return
+
+        signal, rate = item.signal, cfg.audio.sampling_rate
+        self.audio.set_signal(signal)
+
+        start_seconds = 0 if self.start_seconds is None else self.start_seconds
+        if item.is_last:
+            # if needed, pad the signal with zeros to get the last spectrogram; the signal may start at
+            # window_start (with --start, or in streaming mode), so use the end time in the recording
+            total_seconds = item.window_start + signal.shape[0] / rate
+            last_segment_len = total_seconds - cfg.audio.segment_len * (total_seconds // cfg.audio.segment_len)
+            if last_segment_len > 0.5:
+                # more than 1/2 a second at the end, so we'd better analyze it
+                pad_amount = int(rate * (cfg.audio.segment_len - last_segment_len)) + 1
+                signal = np.pad(signal, (0, pad_amount), 'constant', constant_values=(0, 0))
+
+            max_end_seconds = max(0, item.window_start + (signal.shape[0] / rate) - cfg.audio.segment_len)
+            end_seconds = max_end_seconds if self.end_seconds is None else self.end_seconds
+            stop_seconds = end_seconds + 1.0
+        else:
+            # in streaming mode, offsets in [window_start, window_start + window_seconds) belong to this window
+            end_seconds = item.window_start + cfg.audio.spec_block_seconds
+            stop_seconds = end_seconds if self.end_seconds is None else min(end_seconds, self.end_seconds + 1.0)
 
-        spec_array = np.zeros((len(specs), 1, cfg.audio.spec_height, cfg.audio.spec_width))
+        # offsets are a subset of those for the whole recording, so they're the same in streaming mode
+        increment = max(0.5, cfg.audio.segment_len - self.overlap)
+        offsets = np.arange(start_seconds, stop_seconds, increment)
+        item.offsets = offsets[offsets >= item.window_start].tolist()
+        # segments are located by sample index relative to the start of the signal, rounding each time in the
+        # recording to a sample as the decoder does, so fractional start times or window sizes give the same
+        # samples as whole-file decoding, and segments stay on the block frame grid
+        window_start = int(round(item.window_start * rate))
+        window_starts = [int(round(offset * rate)) - window_start for offset in item.offsets]
+
+        # raw spectrograms are used by the pre-screen, and by species handlers if they're kept for the whole recording
+        keep_raw_spectrograms = species_handlers.RAW_SPECTROGRAMS in self.handler_resources and not cfg.infer.stream
+        raw_spectrograms = [0 for i in range(len(item.offsets))] if cfg.infer.prescreen or keep_raw_spectrograms else None
+
+        # low band spectrograms are derived from the same STFT, if a species handler needs them
+        low_band_specs = [0 for i in range(len(item.offsets))] if species_handlers.LOW_BAND in self.handler_resources else None
+        specs = self.audio.get_spectrograms(window_starts, segment_len=cfg.audio.segment_len, raw_spectrograms=raw_spectrograms,
+                                            from_blocks=cfg.infer.spec_from_blocks, low_band_specs=low_band_specs, in_samples=True)
+        item.low_band_specs = None if low_band_specs is None else audio.get_spec_array(low_band_specs, cfg.audio.low_band_spec_height)
+
+        # optionally find segments that are worth running the models on, i.e. where some frequency is well above its noise floor
+        item.active = None
+        if cfg.infer.prescreen and len(specs) > 0:
+            item.active = audio.get_segment_activity(raw_spectrograms) >= cfg.infer.prescreen_threshold
+
+        # raw spectrograms are only kept for the whole recording, since they take a lot of memory
+        item.raw_spectrograms = raw_spectrograms if keep_raw_spectrograms else None
+
+        item.specs = np.zeros((len(specs), 1, cfg.audio.spec_height, cfg.audio.spec_width), dtype=np.float32)
         for i in range(len(specs)):
             if specs[i] is not None:
-                spec_array[i] = specs[i].reshape((1, cfg.audio.spec_height, cfg.audio.spec_width)).astype(np.float32)
+                item.specs[i] = specs[i].reshape((1, cfg.audio.spec_height, cfg.audio.spec_width))
+            else:
+                logging.debug(f"No spectrogram returned for offset {i} ({item.offsets[i]:.2f})")
+
+        # in sliding window mode, the per-segment spectrograms are still used by models that don't support strips
+        item.strips = self.audio.get_strips(window_starts, cfg.infer.strip_seconds, in_samples=True) if self.use_strips and len(specs) > 0 else None
+        item.signal = None # no longer needed, so don't keep it in the queue
+        logging.debug(f"Analyzing from {item.window_start} to {end_seconds} seconds")
+        logging.debug(f"Retrieved {len(specs)} spectrograms")
+
+    # yield work items with decoded audio; normally this is one item for the whole recording,
+    # but in streaming mode it is one per window of cfg.audio.spec_block_seconds, where each window
+    # includes an extra segment_len seconds so the last segments of the window are complete
+    def _decode(self, file_path):
+        if self._skip_file(file_path):
+            return
+
+        # if the results for this recording are cached, skip decoding and inference
+        cache_key = None
+        if self.cache is not None:
+            cache_key = hashlib.sha256((cache.hash_file(file_path) + self.cache_settings_key).encode()).hexdigest()
+            cached = self.cache.get(cache_key)
+            if cached is not None and species_handlers.LOW_BAND in self.handler_resources and 'low_band_predictions' not in cached:
+                cached = None # cached by a run that didn't need low band predictions, e.g. because RUGR was ignored
+
+            if cached is not None:
+                yield SimpleNamespace(file_path=file_path, cached=cached, is_first=True, is_last=True)
+                return
+
+        if not cfg.infer.stream:
+            # if a start or end time is specified, only decode that part of the recording
+            window_start = 0 if self.start_seconds is None else self.start_seconds
+            duration = None if self.end_seconds is None else self.end_seconds + 1.0 + cfg.audio.segment_len - window_start
+            signal, _ = self.decode_audio.load(file_path, offset=window_start, duration=duration)
+            if self.decode_audio.have_signal:
+                yield SimpleNamespace(file_path=file_path, signal=signal, window_start=window_start, is_first=True, is_last=True, cached=None, cache_key=cache_key)
             else:
-                logging.debug(f"No spectrogram returned for offset {i} ({self.offsets[i]:.2f})")
+                self.manifest.update(file_path, manifest.FAILED)
+
+            return
+
+        window_start = 0 if self.start_seconds is None else self.start_seconds
+        window_seconds = cfg.audio.spec_block_seconds
+        channel = None # once chosen from the first window, use the same channel for the rest
+        is_first = True
+        while True:
+            signal, rate = self.decode_audio.load(file_path, offset=window_start, duration=window_seconds + cfg.audio.segment_len, channel=channel)
+            if not self.decode_audio.have_signal:
+                if not is_first:
+                    logging.error(f"Error: unable to read {file_path} after {window_start} seconds")
+
+                self.manifest.update(file_path, manifest.FAILED)
+                return
+
+            channel = self.decode_audio.channel
+            is_last = len(signal) < int((window_seconds + cfg.audio.segment_len) * rate) or \
+                      (self.end_seconds is not None and window_start + window_seconds > self.end_seconds + 1.0)
+
+            yield SimpleNamespace(file_path=file_path, signal=signal, window_start=window_start, is_first=is_first, is_last=is_last,
+                                  cached=None, cache_key=cache_key)
+            if is_last:
+                return
+
+            window_start += window_seconds
+            is_first = False
 
-        return spec_array
+    # return the scores for a work item, before score_exponent is applied; segments skipped by the pre-screen,
+    # or by adaptive overlap, get zero scores
+    def _get_item_scores(self, item):
+        if item.strips is not None:
+            strips, strip_index, start_frames = item.strips
+            return self.ensemble.get_strip_predictions(strips, strip_index, start_frames, item.specs)
 
-    def _analyze_file(self, file_path):
+        if item.active is None and not cfg.infer.adaptive_overlap:
+            return self._get_scores(item.specs)
+
+        scores = np.zeros((len(item.specs), len(self.class_infos)), dtype=np.float32)
+        active = np.ones(len(item.specs), dtype=bool) if item.active is None else item.active
+        if item.active is not None:
+            self.prescreen_skipped += len(active) - active.sum()
+            self.prescreen_total += len(active)
+
+        if not cfg.infer.adaptive_overlap:
+            if active.any():
+                scores[active] = self._get_scores(item.specs[active])
+
+            return scores
+
+        # With adaptive overlap, first run the models on segments that don't overlap, i.e. every k-th offset in
+        # the recording, plus the first and last of each item so the edges are covered. Then run them on the
+        # overlapping segments next to any where a non-ignored class may be above min_score. The offsets and the
+        # score matrix are the same as without adaptive overlap, except that the skipped segments have zero scores,
+        # so label merging and the species handlers work as usual.
+        increment = max(0.5, cfg.audio.segment_len - self.overlap)
+        k = max(1, int(round(cfg.audio.segment_len / increment)))
+        start_seconds = 0 if self.start_seconds is None else self.start_seconds
+        index = np.round((np.array(item.offsets) - start_seconds) / increment).astype(int)
+        coarse = (index % k == 0)
+        coarse[[0, -1]] = True
+        coarse &= active
+        if coarse.any():
+            scores[coarse] = self._get_scores(item.specs[coarse])
+
+        threshold = (cfg.infer.adaptive_fraction * cfg.infer.min_score) ** (1 / cfg.infer.score_exponent)
+        possible = (coarse & (scores[:, ~self.ignore_mask] >= threshold).any(axis=1)).astype(int)
+        near_possible = np.convolve(possible, np.ones(2 * k - 1, dtype=int), mode='same') > 0 # within k - 1 offsets
+        fine = ~coarse & active & near_possible
+        if fine.any():
+            scores[fine] = self._get_scores(item.specs[fine])
+
+        self.adaptive_run += coarse.sum() + fine.sum()
+        self.adaptive_total += len(scores)
+        return scores
+
+    # run the models on a work item; when it's the last item for a recording, combine the results
+    # for all of its items and generate the labels
+    def _process_item(self, item):
+        if item.cached is not None:
+            self.offsets = item.cached['offsets'].tolist()
+            self.raw_spectrograms = None # not cached, so the amplitude handler is skipped
+            self._finish_file(item.file_path, item.cached['scores'], item.cached.get('low_band_predictions'))
+            return
+
+        if item.is_first:
+            self.results = SimpleNamespace(offsets=[], scores=[], raw_spectrograms=[], low_band_predictions=[], embeddings=[])
+
+        if len(item.offsets) > 0:
+            # a final window can be empty if the previous one covered the rest of the recording
+            self.results.offsets.extend(item.offsets)
+            self.results.scores.append(self._get_item_scores(item))
+            if item.low_band_specs is not None:
+                self.results.low_band_predictions.append(self.ensemble.get_low_band_predictions(item.low_band_specs))
+            if item.raw_spectrograms is not None:
+                self.results.raw_spectrograms.extend(item.raw_spectrograms)
+
+            # optionally generate embeddings
+            if self.embed:
+                self.results.embeddings.append(self.embed_model.get_embeddings(item.specs, self.device))
+
+        if item.is_last and len(self.results.offsets) > 0:
+            self.offsets = self.results.offsets
+            self.raw_spectrograms = self.results.raw_spectrograms if len(self.results.raw_spectrograms) > 0 else None
+            if self.embed:
+                self.embeddings = np.concatenate(self.results.embeddings)
+
+            scores = np.concatenate(self.results.scores)
+            low_band_predictions = np.concatenate(self.results.low_band_predictions) if len(self.results.low_band_predictions) > 0 else None
+            if item.cache_key is not None:
+                arrays = {'scores': scores, 'offsets': np.array(self.offsets)}
+                if low_band_predictions is not None:
+                    arrays['low_band_predictions'] = low_band_predictions
+
+                self.cache.put(item.cache_key, arrays)
+
+            self._finish_file(item.file_path, scores, low_band_predictions)
+            self.results = None
+
+    # given the scores for a recording before score_exponent is applied, generate and save the labels
+    def _finish_file(self, file_path, scores, low_band_predictions):
+        if cfg.infer.save_scores:
+            self._save_scores(file_path, scores, low_band_predictions)
+
+        # score_exponent is monotonic, so applying it after merging filtered scores gives the same result
+        self._analyze_file(file_path, scores ** cfg.infer.score_exponent, low_band_predictions)
+        self.manifest.update(file_path, manifest.DONE)
+
+    # when a filelist is specified, only the recordings in that file are processed;
+    # so you can specify a filelist with no locations or dates if you want to restrict the recording
+    # list but not invoke location/date processing; you still need the standard CSV format
+    # with the expected number of columns, but latitude/longitude/date can be empty
+    def _skip_file(self, file_path):
+        if not self.check_frequency or self.location_date_dict is None:
+            return False
+
+        filename = Path(file_path).name
+        if filename in self.location_date_dict:
+            return False
+
+        if not self.issued_skip_files_warning:
+            logging.info(f"Thread {self.thread_num}: skipping some recordings that were not included in {self.filelist} (e.g. {filename})")
+            self.issued_skip_files_warning = True
+
+        return True
+
+    def _analyze_file(self, file_path, scores, low_band_predictions):
         check_frequency = self.check_frequency
         if check_frequency:
             if self.location_date_dict is not None:
@@ -406,16 +779,6 @@ class Analyzer:
                             logging.warning(f"Warning: no matching county found for latitude={latitude} and longitude={longitude}")
                         else:
                             self._update_class_frequency_stats([county])
-                else:
-                    # when a filelist is specified, only the recordings in that file are processed;
-                    # so you can specify a filelist with no locations or dates if you want to restrict the recording
-                    # list but not invoke location/date processing; you still need the standard CSV format
-                    # with the expected number of columns, but latitude/longitude/date can be empty
-                    if not self.issued_skip_files_warning:
-                        logging.info(f"Thread {self.thread_num}: skipping some recordings that were not included in {self.filelist} (e.g. {filename})")
-                        self.issued_skip_files_warning = True
-
-                    return
             elif self.get_date_from_file_name:
                 result = re.split(cfg.infer.file_date_regex, os.path.basename(file_path))
                 if len(result) > cfg.infer.file_date_regex_group:
@@ -437,77 +800,32 @@ class Analyzer:
                 elif class_info.frequency[self.week_num - 1] < cfg.infer.min_location_freq:
                     class_info.ebird_frequency_too_low = True
 
-        signal, rate = self.audio.load(file_path)
-
-        if not self.audio.have_signal:
-            return
-
-        self._get_predictions(signal, rate)
+        self._set_scores(scores)
 
         # do pre-processing for individual species
-        self.species_handlers.reset(self.class_infos, self.offsets, self.raw_spectrograms, self.audio, self.check_frequency, self.week_num)
+        self.species_handlers.reset(self.class_infos, self.offsets, self.raw_spectrograms, low_band_predictions, self.check_frequency, self.week_num)
         for class_info in self.class_infos:
             if  not class_info.ignore and class_info.code in self.species_handlers.handlers:
                 self.species_handlers.handlers[class_info.code](class_info)
 
-        # generate labels for one class at a time
+        # generate labels for all classes that have any
+        columns = [class_info.index for class_info in self.class_infos if not class_info.ignore and class_info.has_label]
+        label_engine.mark_labels(self.scores, self.is_label, columns, self.overlap)
+
         labels = []
         rarities_labels = []
-        for class_info in self.class_infos:
-            if class_info.ignore or not class_info.has_label:
-                continue
-
+        for column, start_time, end_time, score in label_engine.get_labels(self.scores, self.is_label, self.offsets, columns, self.merge_labels):
+            class_info = self.class_infos[column]
             if cfg.infer.use_banding_codes:
                 name = class_info.code
             else:
                 name = class_info.name
 
-            # set is_label[i] = True for any offset that qualifies in a first pass
-            scores = class_info.scores
-            for i in range(len(scores)):
-                if scores[i] < cfg.infer.min_score or scores[i] == 0: # check for -p 0 case
-                    continue
-
-                class_info.is_label[i] = True
-
-            # raise scores if the species' presence is confirmed
-            if cfg.infer.lower_min_if_confirmed and cfg.infer.min_score > 0:
-                # calculate number of seconds labelled so far
-                seconds = 0
-                raised_min_score = cfg.infer.min_score + cfg.infer.raise_min_to_confirm * (1 - cfg.infer.min_score)
-                for i in range(len(class_info.is_label)):
-                    if class_info.is_label[i] and scores[i] >= raised_min_score:
-                        if i > 0 and class_info.is_label[i - 1]:
-                            seconds += self.overlap
-                        else:
-                            seconds += cfg.audio.segment_len
-
-                if seconds > cfg.infer.confirmed_if_seconds:
-                    # species presence is considered confirmed, so lower the min score and scan again
-                    lowered_min_score = cfg.infer.lower_min_factor * cfg.infer.min_score
-                    for i in range(len(scores)):
-                        if not class_info.is_label[i] and scores[i] >= lowered_min_score:
-                            class_info.is_label[i] = True
-                            scores[i] = cfg.infer.min_score # display it as min_score in the label
-
-            # generate the labels
-            prev_label = None
-            for i in range(len(scores)):
-                if class_info.is_label[i]:
-                    end_time = self.offsets[i] + cfg.audio.segment_len
-                    if self.merge_labels and prev_label != None and prev_label.end_time >= self.offsets[i]:
-                        # extend the previous label's end time (i.e. merge)
-                        prev_label.end_time = end_time
-                        prev_label.score = max(scores[i], prev_label.score)
-                    else:
-                        label = Label(name, scores[i], self.offsets[i], end_time)
-
-                        if class_info.ebird_frequency_too_low:
-                            rarities_labels.append(label)
-                        else:
-                            labels.append(label)
-
-                        prev_label = label
+            label = Label(name, score, start_time, end_time)
+            if class_info.ebird_frequency_too_low:
+                rarities_labels.append(label)
+            else:
+                labels.append(label)
 
         self._save_labels(labels, file_path, False)
         self._save_labels(rarities_labels, file_path, True)
@@ -549,6 +867,47 @@ class Analyzer:
             logging.error(f"Unable to write file {output_path}")
             quit()
 
+    # save the score matrix (before score_exponent is applied) as float16, with the offsets and low band predictions,
+    # so relabel.py can generate labels with different settings without running the models again
+    def _save_scores(self, file_path, scores, low_band_predictions):
+        name = Path(file_path).name
+        np.save(os.path.join(self.scores_output_path, f'{name}.scores.npy'), scores.astype(np.float16))
+        np.save(os.path.join(self.scores_output_path, f'{name}.offsets.npy'), np.array(self.offsets, dtype=np.float64))
+        if low_band_predictions is not None:
+            np.save(os.path.join(self.scores_output_path, f'{name}.low_band.npy'), low_band_predictions.astype(np.float16))
+
+    # regenerate labels from scores saved by a previous run with --scores, without loading any models;
+    # label settings such as min_score and score_exponent are taken from cfg.infer as usual
+    def relabel(self, scores_path):
+        class_list = util.get_class_list(os.path.join(scores_path, 'classes.txt'))
+        class_dict = util.get_class_dict(os.path.join(scores_path, 'classes.txt'))
+        if len(class_list) == 0:
+            logging.error(f"Error: no class list found in {scores_path}")
+            quit()
+
+        self.class_infos = self._get_class_infos(class_list, [class_dict[name] for name in class_list])
+        self._process_location_and_date()
+        self.species_handlers = species_handlers.Species_Handlers(self.device)
+        self.raw_spectrograms = None # so the amplitude handler is skipped
+
+        for score_path in sorted(glob.glob(os.path.join(scores_path, '*.scores.npy'))):
+            file_path = score_path[:-len('.scores.npy')] # the recording name, which may be needed for location/date processing
+            if self._skip_file(file_path):
+                continue
+
+            scores = np.load(score_path).astype(np.float32)
+            if scores.shape[1] != len(self.class_infos):
+                logging.error(f"Error: {score_path} has {scores.shape[1]} classes but {len(self.class_infos)} were expected")
+                continue
+
+            self.offsets = np.load(f'{file_path}.offsets.npy').tolist()
+            if len(self.offsets) > 1:
+                self.overlap = cfg.audio.segment_len - (self.offsets[1] - self.offsets[0]) # as used when the scores were saved
+
+            low_band_path = f'{file_path}.low_band.npy' # not saved if no species handler needed it
+            low_band_predictions = np.load(low_band_path).astype(np.float32) if os.path.exists(low_band_path) else None
+            self._analyze_file(file_path, scores ** cfg.infer.score_exponent, low_band_predictions)
+
     def _save_embeddings(self, file_path):
         embedding_list = []
 
@@ -582,44 +941,202 @@ class Analyzer:
         logging.info(f"Sum={sum}")
         logging.info("")
 
+    # file_list is either a list of paths or a queue shared by all threads
     def run(self, file_list):
+        if not isinstance(file_list, list):
+            file_list = self._get_queued_files(file_list)
+
         torch.cuda.empty_cache()
-        model_paths = glob.glob(os.path.join(cfg.misc.main_ckpt_folder, "*.ckpt"))
-        if len(model_paths) == 0:
-            logging.error(f"Error: no checkpoints found in {cfg.misc.main_ckpt_folder}")
-            quit()
+        if self.loaded_models is None:
+            self.loaded_models = Analyzer._load_models(self.device, self.embed)
+
+        self.models = self.loaded_models.main
+        self.ensemble = ensemble.Ensemble(self.models, self.device, self.loaded_models.low_band)
+        self.embed_model = self.loaded_models.embed
+        class_names, class_codes = self.models[0].train_class_names, self.models[0].train_class_codes
+
+        self.decode_audio = audio.Audio(device=self.device) # used by the decode stage
+        self.audio = audio.Audio(device=self.device)        # used by the spectrogram stage
+        self.class_infos = self._get_class_infos(class_names, class_codes)
+        self.ignore_mask = np.array([class_info.ignore for class_info in self.class_infos])
+        if cfg.infer.cascade:
+            # escalate if a non-ignored class may be above cascade_fraction * min_score after score_exponent is applied
+            threshold = (cfg.infer.cascade_fraction * cfg.infer.min_score) ** (1 / cfg.infer.score_exponent)
+            self.ensemble.set_cascade(threshold, ~self.ignore_mask)
+
+        # sliding window inference replaces the per-segment model calls, so it doesn't apply with options that change them
+        self.use_strips = cfg.infer.sliding_window
+        if self.use_strips:
+            if not any(hasattr(model, 'supports_strips') and model.supports_strips() for model in self.models):
+                logging.warning(f"Thread {self.thread_num}: no models support sliding window inference, so it is disabled")
+                self.use_strips = False
+            elif self.filter_variants is not None or not cfg.infer.do_unfiltered or cfg.infer.cascade or cfg.infer.adaptive_overlap or cfg.infer.prescreen:
+                logging.warning(f"Thread {self.thread_num}: sliding window inference is disabled, since it doesn't support filters, cascade, adaptive overlap or the pre-screen")
+                self.use_strips = False
 
-        self.models = []
-        for model_path in model_paths:
-            model = main_model.MainModel.load_from_checkpoint(model_path, map_location=torch.device(self.device))
-            model.eval() # set inference mode
-            self.models.append(model)
+        self._process_location_and_date()
+        self.species_handlers = species_handlers.Species_Handlers(self.device, self.loaded_models.low_band)
+        self.handler_resources = self.species_handlers.get_resources([class_info.code for class_info in self.class_infos if not class_info.ignore])
+        self.manifest = manifest.Manifest(self.manifest_path, self.settings_key)
+        self.prescreen_skipped, self.prescreen_total = 0, 0
+        self.adaptive_run, self.adaptive_total = 0, 0
+
+        # embeddings aren't cached, so don't use the cache when generating them
+        self.cache = None
+        if cfg.infer.cache_path is not None and not self.embed:
+            self.cache = cache.Result_Cache(cfg.infer.cache_path, int(cfg.infer.cache_max_gb * 1e9))
+            self.cache_settings_key = self._get_cache_settings_key()
+
+        if cfg.infer.save_scores:
+            # save the class list with the scores, so labels can be generated from them later without the models
+            self.scores_output_path = os.path.join(self.output_path, 'scores')
+            os.makedirs(self.scores_output_path, exist_ok=True)
+            # (write a temporary file and rename it, since other threads may be doing the same)
+            temp_path = os.path.join(self.scores_output_path, f'classes.{os.getpid()}.{self.thread_num}.tmp')
+            with open(temp_path, 'w') as file:
+                for class_name, class_code in zip(class_names, class_codes):
+                    file.write(f'{class_name},{class_code}\n')
+
+            os.replace(temp_path, os.path.join(self.scores_output_path, 'classes.txt'))
+
+        if cfg.infer.pipeline_depth > 0:
+            self._run_pipeline(file_list)
+        else:
+            for file_path in file_list:
+                for item in self._decode(file_path):
+                    self._get_specs(item)
+                    self._process_item(item)
 
-        if self.embed:
-            self.embed_model = main_model.MainModel.load_from_checkpoint(cfg.misc.search_ckpt_path, map_location=torch.device(self.device))
-            self.embed_model.eval()
+        if cfg.infer.cascade and self.ensemble.num_screened > 0:
+            logging.info(f"Thread {self.thread_num}: cascade escalated {self.ensemble.num_escalated} of {self.ensemble.num_screened} spectrograms ({100 * self.ensemble.num_escalated / self.ensemble.num_screened:.1f}%)")
 
-        self.audio = audio.Audio(device=self.device)
-        self.class_infos = self._get_class_infos()
-        self._process_location_and_date()
-        self.species_handlers = species_handlers.Species_Handlers(self.device)
+        if self.adaptive_total > 0:
+            logging.info(f"Thread {self.thread_num}: adaptive overlap ran the models on {self.adaptive_run} of {self.adaptive_total} segments ({100 * self.adaptive_run / self.adaptive_total:.1f}%)")
+
+        if self.prescreen_total > 0:
+            logging.info(f"Thread {self.thread_num}: pre-screen skipped {self.prescreen_skipped} of {self.prescreen_total} segments ({100 * self.prescreen_skipped / self.prescreen_total:.1f}%)")
+
+        self.manifest.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    # put an item in a pipeline queue, recording how long the given stage waited for space;
+    # return False without putting it if the pipeline is stopping because a stage failed
+    def _put(self, work_queue, item, stage):
+        start_time = time.time()
+        try:
+            while not self.pipeline_stop.is_set():
+                try:
+                    work_queue.put(item, timeout=PIPELINE_POLL_SECONDS)
+                    return True
+                except queue.Full:
+                    pass
+
+            return False
+        finally:
+            self.wait_times[stage]['output'] += time.time() - start_time
+
+    # get an item from a pipeline queue, recording how long the given stage waited for input;
+    # return None if the pipeline is stopping because a stage failed
+    def _get(self, work_queue, stage):
+        start_time = time.time()
+        try:
+            while not self.pipeline_stop.is_set():
+                try:
+                    return work_queue.get(timeout=PIPELINE_POLL_SECONDS)
+                except queue.Empty:
+                    pass
+
+            return None
+        finally:
+            self.wait_times[stage]['input'] += time.time() - start_time
+
+    # Run decoding, spectrogram creation and model inference (plus label generation) as separate stages,
+    # connected by bounded queues, so the next file is decoded and converted to spectrograms while the models
+    # run on the current one. A stage that spends a lot of time waiting for input is downstream of the
+    # bottleneck, and one that waits for output space is upstream of it. If a stage raises an exception,
+    # the others are stopped and the first exception is raised here.
+    def _run_pipeline(self, file_list):
+        decode_queue = queue.Queue(maxsize=cfg.infer.pipeline_depth)
+        spec_queue = queue.Queue(maxsize=cfg.infer.pipeline_depth)
+        self.wait_times = {stage: {'input': 0, 'output': 0} for stage in ['decode', 'spec', 'model']}
+        self.pipeline_stop = threading.Event()
+        errors = []
+
+        def fail(e):
+            errors.append(e)
+            self.pipeline_stop.set()
+
+        def decode_stage():
+            try:
+                for file_path in file_list:
+                    for item in self._decode(file_path):
+                        if not self._put(decode_queue, item, 'decode'):
+                            return
+
+                self._put(decode_queue, None, 'decode') # tell the next stage we're done
+            except Exception as e:
+                fail(e)
+
+        def spec_stage():
+            try:
+                while True:
+                    item = self._get(decode_queue, 'spec')
+                    if item is None:
+                        break
+
+                    self._get_specs(item)
+                    if not self._put(spec_queue, item, 'spec'):
+                        return
+
+                self._put(spec_queue, None, 'spec')
+            except Exception as e:
+                fail(e)
+
+        threads = [threading.Thread(target=decode_stage), threading.Thread(target=spec_stage)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._get(spec_queue, 'model')
+                if item is None:
+                    break
+
+                self._process_item(item)
+        except Exception as e:
+            fail(e)
+
+        for thread in threads:
+            thread.join()
 
-        for file_path in file_list:
-            self._analyze_file(file_path)
+        if len(errors) > 0:
+            raise errors[0]
+
+        for stage in self.wait_times:
+            logging.info(f"Thread {self.thread_num}: {stage} stage waited {self.wait_times[stage]['input']:.1f}s for input and {self.wait_times[stage]['output']:.1f}s for output")
 
 if __name__ == '__main__':
     # command-line arguments
     parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', type=str, default=cfg.infer.backend, choices=['torch', 'script', 'onnx', 'int8'], help=f'Use "script" to load the faster-loading TorchScript models from tools/export_script.py, "onnx" to run models exported by tools/export_onnx.py with ONNX Runtime on CPU, or "int8" to run the quantized versions from tools/quantize.py. Default = {cfg.infer.backend}.')
     parser.add_argument('-b', '--band', type=int, default=1 * cfg.infer.use_banding_codes, help=f"If 1, use banding codes labels. If 0, use common names. Default = {1 * cfg.infer.use_banding_codes}.")
+    parser.add_argument('--cache', type=str, default=cfg.infer.cache_path, help=f'Optional directory for a cache of inference results, so recordings that were analyzed before with the same checkpoints and settings are skipped, even if they were moved or copied. Default = {cfg.infer.cache_path}.')
     parser.add_argument('-d', '--debug', default=False, action='store_true', help='Flag for debug mode (analyze one spectrogram only, and output several top candidates).')
     parser.add_argument('--embed', default=False, action='store_true', help='If specified, generate a pickle file containing embeddings for each recording processed.')
     parser.add_argument('-e', '--end', type=str, default='', help="Optional end time in hh:mm:ss format, where hh and mm are optional.")
     parser.add_argument('-i', '--input', type=str, default='', help="Input path (single audio file or directory). No default.")
     parser.add_argument('-o', '--output', type=str, default='', help="Output directory to contain label files. Default is input path, if that is a directory.")
+    parser.add_argument('--order', type=str, default=cfg.infer.file_order, choices=['name', 'size', 'duration'], help=f'With multiple threads, process the largest files first by "size" or "duration", or use "name" order. Default = {cfg.infer.file_order}.')
     parser.add_argument('--overlap', type=float, default=cfg.infer.spec_overlap_seconds, help=f"Seconds of overlap for adjacent 3-second spectrograms. Default = {cfg.infer.spec_overlap_seconds}.")
     parser.add_argument('-m', '--merge', type=int, default=1, help=f'Specify 0 to not merge adjacent labels of same species. Default = 1, i.e. merge.')
+    parser.add_argument('--pipeline', type=int, default=cfg.infer.pipeline_depth, help=f'Number of files queued between the decode, spectrogram and model stages, or 0 to process one file at a time. Default = {cfg.infer.pipeline_depth}.')
     parser.add_argument('-p', '--min_score', type=float, default=cfg.infer.min_score, help=f"Generate label if score >= this. Default = {cfg.infer.min_score}.")
+    parser.add_argument('--resume', default=False, action='store_true', help='If specified, skip recordings that were already processed with the same checkpoints and settings, according to the manifest in the output directory. Failed recordings are retried.')
+    parser.add_argument('--scores', default=False, action='store_true', help='If specified, save the score matrix for each recording in a "scores" subdirectory of the output directory, so relabel.py can generate labels with different settings later.')
     parser.add_argument('-s', '--start', type=str, default='', help="Optional start time in hh:mm:ss format, where hh and mm are optional.")
+    parser.add_argument('--share', type=int, default=cfg.infer.share_models, help=f'Specify 1 to load models once and share them across threads (CPU only when using processes), or 0 to load them in each thread. Default = {cfg.infer.share_models}.')
+    parser.add_argument('--stream', default=False, action='store_true', help=f'If specified, decode and analyze recordings in windows of {cfg.audio.spec_block_seconds} seconds, so memory use does not depend on recording length.')
     parser.add_argument('--threads', type=int, default=cfg.infer.num_threads, help=f'Number of threads. Default = {cfg.infer.num_threads}')
     parser.add_argument('--power', type=float, default=cfg.infer.audio_exponent, help=f'Power parameter to mel spectrograms. Default = {cfg.infer.audio_exponent}')
 
@@ -653,9 +1170,16 @@ if __name__ == '__main__':
     logging.info("Initializing")
 
     num_threads = args.threads
+    cfg.infer.num_threads = num_threads
+    cfg.infer.backend = args.backend
     cfg.infer.use_banding_codes = args.band
     cfg.audio.power = args.power
     cfg.infer.min_score = args.min_score
+    cfg.infer.pipeline_depth = args.pipeline
+    cfg.infer.share_models = args.share
+    cfg.infer.stream = args.stream
+    cfg.infer.save_scores = args.scores
+    cfg.infer.cache_path = args.cache
     if cfg.infer.min_score < 0:
         logging.error("Error: min_score must be >= 0")
         quit()
@@ -664,7 +1188,6 @@ if __name__ == '__main__':
         device = 'cuda'
         logging.info(f"Using GPU")
     else:
-        # TODO: use openvino to improve performance when no GPU is available
         device = 'cpu'
         logging.info(f"Using CPU")
 
@@ -685,30 +1208,44 @@ if __name__ == '__main__':
     cfg.infer.bpf_damp = args.bpfdamp
 
     file_list = Analyzer._get_file_list(args.input)
+    if args.resume:
+        analyzer = Analyzer(args.input, args.output, args.start, args.end, args.date, args.lat, args.lon, args.region,
+                            args.filelist, args.debug, args.merge, args.overlap, device, 1, args.embed)
+        file_list = analyzer._get_pending_files(file_list)
+
     if num_threads == 1:
         # keep it simple in case multithreading code has undesirable side-effects (e.g. disabling echo to terminal)
         analyzer = Analyzer(args.input, args.output, args.start, args.end, args.date, args.lat, args.lon, args.region,
                             args.filelist, args.debug, args.merge, args.overlap, device, 1, args.embed)
         analyzer.run(file_list)
     else:
-        # split input files into one group per thread
-        file_lists = [[] for i in range(num_threads)]
-        for i in range(len(file_list)):
-            file_lists[i % num_threads].append(file_list[i])
+        # put input files in a shared queue, so each thread gets the next file when it's ready for one,
+        # followed by one None per thread to tell it to stop
+        file_list = Analyzer._order_file_list(file_list, args.order)
+        file_queue = mp.Queue() if os.name == "posix" else queue.Queue()
+        for file_path in file_list + [None for i in range(num_threads)]:
+            file_queue.put(file_path)
+
+        # optionally load the models once and share them, rather than loading them in every thread;
+        # CUDA tensors can't be inherited by forked processes, so only do this on CPU or with threads;
+        # ONNX Runtime sessions aren't safe to use after a fork, so they're always loaded per process
+        models = None
+        if cfg.infer.share_models and cfg.infer.backend == 'torch' and (device == 'cpu' or os.name != "posix"):
+            models = Analyzer._load_models(device, args.embed)
+            Analyzer._share_models(models)
 
         # for some reason using processes is faster than just using threads, but that disables output on Windows
         processes = []
-        for i in range(num_threads):
-            if len(file_lists[i]) > 0:
-                analyzer = Analyzer(args.input, args.output, args.start, args.end, args.date, args.lat, args.lon, args.region,
-                                    args.filelist, args.debug, args.merge, args.overlap, device, i + 1, args.embed)
-                if os.name == "posix":
-                    process = mp.Process(target=analyzer.run, args=(file_lists[i], ))
-                else:
-                    process = threading.Thread(target=analyzer.run, args=(file_lists[i], ))
-
-                process.start()
-                processes.append(process)
+        for i in range(min(num_threads, len(file_list))):
+            analyzer = Analyzer(args.input, args.output, args.start, args.end, args.date, args.lat, args.lon, args.region,
+                                args.filelist, args.debug, args.merge, args.overlap, device, i + 1, args.embed, models)
+            if os.name == "posix":
+                process = mp.Process(target=analyzer.run, args=(file_queue, ))
+            else:
+                process = threading.Thread(target=analyzer.run, args=(file_queue, ))
+
+            process.start()
+            processes.append(process)
 
         # wait for processes to complete
         for process in processes:
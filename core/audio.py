@@ -6,19 +6,60 @@ import warnings
 warnings.filterwarnings('ignore') # librosa generates too many warnings
 
 import cv2
-import librosa
 import numpy as np
+import soundfile as sf
 import torch
 import torchaudio as ta
 
 from core import cfg
+from core import decoder
+
+# return the duration in seconds given in an audio file's header, or None if it can't be read
+def get_duration(path):
+    try:
+        return sf.info(path).duration
+    except Exception:
+        return None
+
+# Given a list of raw (unnormalized) spectrograms for a recording, return an array with the ratio of each one's
+# peak to the noise floor, where the noise floor of each frequency row is its median across the recording.
+# Bird sounds are often narrow-band, so this compares values in the same row rather than frame energies, which
+# are dominated by broadband noise. The noise floor is estimated from up to 100 spectrograms spaced across the list.
+# The lowest rows often hold loud noise, so they're ignored, as in Species_Handlers.get_highest_amplitude.
+# Missing spectrograms get a ratio of 0.
+def get_segment_activity(raw_spectrograms, min_row=5):
+    present = [spec for spec in raw_spectrograms if spec is not None]
+    activity = np.zeros(len(raw_spectrograms), dtype=np.float32)
+    if len(present) == 0:
+        return activity
+
+    sample = np.stack(present[::max(1, len(present) // 100)])[:, min_row:, :]
+    noise_floor = np.median(sample.transpose(1, 0, 2).reshape(sample.shape[1], -1), axis=1)
+    noise_floor = np.maximum(noise_floor, 1e-6 * max(1e-12, sample.max()))[:, np.newaxis] # avoid dividing by 0 in digital silence
+
+    for i, spec in enumerate(raw_spectrograms):
+        if spec is not None:
+            activity[i] = (spec[min_row:] / noise_floor).max()
+
+    return activity
+
+# return a list of spectrograms with the given height as one float32 array for a model, with zeros for missing ones
+def get_spec_array(specs, spec_height):
+    spec_array = np.zeros((len(specs), 1, spec_height, cfg.audio.spec_width), dtype=np.float32)
+    present = [i for i, spec in enumerate(specs) if spec is not None]
+    if len(present) > 0:
+        spec_array[present, 0] = np.stack([specs[i] for i in present])
+
+    return spec_array
 
 class Audio:
     def __init__(self, device='cuda'):
         self.have_signal = False
         self.path = None
         self.signal = None
+        self.channel = None # channel chosen by the last load of a stereo recording
         self.device = device
+        self.decoder = decoder.Decoder()
 
         self.linear_transform = ta.transforms.Spectrogram(
             n_fft=2*cfg.audio.win_length,
@@ -41,32 +82,44 @@ class Audio:
     # width of spectrogram is determined by input signal length, and height = cfg.audio.spec_height;
     # low_band = True gets a low-frequency spectrogam used to detect Ruffed Grouse drumming
     def _get_raw_spectrogram(self, signal, low_band=False):
-        if low_band:
-            min_audio_freq = cfg.audio.low_band_min_audio_freq
-            max_audio_freq = cfg.audio.low_band_max_audio_freq
-            spec_height = cfg.audio.low_band_spec_height
-            mel_scale = cfg.audio.low_band_mel_scale
-        else:
-            min_audio_freq = cfg.audio.min_audio_freq
-            max_audio_freq = cfg.audio.max_audio_freq
-            spec_height = cfg.audio.spec_height
-            mel_scale = cfg.audio.mel_scale
-
-        signal = signal.reshape((1, signal.shape[0]))
-        tensor = torch.from_numpy(signal).to(self.device)
-        if mel_scale:
-            spec = self.mel_transform(tensor).cpu().numpy()[0]
-        else:
-            spec = self.linear_transform(tensor).cpu().numpy()[0]
+        return self._get_raw_spectrograms(signal, [low_band])[0]
+
+    # return a raw spectrogram of the signal for each value in bands, where each value is a low_band flag;
+    # the mel and linear transforms use the same STFT parameters, so the STFT magnitude is computed
+    # once and each spectrogram is derived from it; if the signal has shape (channels, samples),
+    # all channels are transformed in one batch and each spectrogram has a leading channel dimension
+    def _get_raw_spectrograms(self, signal, bands):
+        tensor = torch.from_numpy(np.ascontiguousarray(signal).reshape((-1, signal.shape[-1]))).to(self.device)
+        magnitude = self.linear_transform(tensor)
+
+        specs = []
+        for low_band in bands:
+            if low_band:
+                min_audio_freq = cfg.audio.low_band_min_audio_freq
+                max_audio_freq = cfg.audio.low_band_max_audio_freq
+                spec_height = cfg.audio.low_band_spec_height
+                mel_scale = cfg.audio.low_band_mel_scale
+            else:
+                min_audio_freq = cfg.audio.min_audio_freq
+                max_audio_freq = cfg.audio.max_audio_freq
+                spec_height = cfg.audio.spec_height
+                mel_scale = cfg.audio.mel_scale
+
+            if mel_scale:
+                power = self.mel_transform.spectrogram.power
+                spec = self.mel_transform.mel_scale(magnitude if power == 1 else magnitude.pow(power)).cpu().numpy()
+            else:
+                spec = magnitude.cpu().numpy()
 
-        if not mel_scale:
-            # clip frequencies above max_audio_freq and below min_audio_freq
-            high_clip_idx = int(2 * spec.shape[0] * max_audio_freq / cfg.audio.sampling_rate)
-            low_clip_idx = int(2 * spec.shape[0] * min_audio_freq / cfg.audio.sampling_rate)
-            spec = spec[:high_clip_idx, low_clip_idx:]
-            spec = cv2.resize(spec, dsize=(spec.shape[1], spec_height), interpolation=cv2.INTER_AREA)
+                # clip frequencies above max_audio_freq and below min_audio_freq
+                high_clip_idx = int(2 * spec.shape[1] * max_audio_freq / cfg.audio.sampling_rate)
+                low_clip_idx = int(2 * spec.shape[1] * min_audio_freq / cfg.audio.sampling_rate)
+                spec = spec[:, :high_clip_idx, low_clip_idx:]
+                spec = np.stack([cv2.resize(channel_spec, dsize=(spec.shape[2], spec_height), interpolation=cv2.INTER_AREA) for channel_spec in spec])
 
-        return spec
+            specs.append(spec if signal.ndim > 1 else spec[0])
+
+        return specs
 
     # normalize values between 0 and 1
     def _normalize(self, specs):
@@ -81,25 +134,28 @@ class Audio:
             specs[i] = specs[i].clip(0, 1)
 
     # stereo recordings sometimes have one clean channel and one noisy one;
-    # so rather than just merge them, use heuristics to pick the cleaner one
-    def _choose_channel(self, left_signal, right_signal):
-        recording_seconds = int(len(left_signal) / cfg.audio.sampling_rate)
+    # so rather than just merge them, use heuristics to pick the cleaner one;
+    # signal has shape (channels, samples) and only the first cfg.audio.check_seconds are used, so it can
+    # be just that part of the recording; return the index of the channel to use, i.e. 0 for left or 1 for right
+    def _choose_channel(self, signal):
+        recording_seconds = int(signal.shape[1] / cfg.audio.sampling_rate)
         check_seconds = min(recording_seconds, cfg.audio.check_seconds)
         if check_seconds == 0:
             # make an arbitrary choice, unless a channel is null
-            left_sum = np.sum(left_signal)
-            right_sum = np.sum(right_signal)
+            left_sum = np.sum(signal[0])
+            right_sum = np.sum(signal[1])
             if left_sum == 0 and right_sum != 0:
-                return right_signal
+                return 1
             elif left_sum != 0 and right_sum == 0:
-                return left_signal
+                return 0
             else:
-                return left_signal
+                return 0
 
-        self.signal = left_signal
-        left_spec = self.get_spectrograms([0], segment_len=check_seconds)[0]
-        self.signal = right_signal
-        right_spec = self.get_spectrograms([0], segment_len=check_seconds)[0]
+        # transform both channels in one batch, then normalize each as get_spectrograms does
+        specs = self._get_raw_spectrograms(signal[:2, :int(check_seconds * cfg.audio.sampling_rate)], [False])[0]
+        specs = list(specs[:, :cfg.audio.spec_height, :cfg.audio.spec_width])
+        self._normalize(specs)
+        left_spec, right_spec = specs
 
         left_sum = left_spec.sum()
         right_sum = right_spec.sum()
@@ -107,17 +163,17 @@ class Audio:
 
         if left_sum == 0 and right_sum > 0:
             # left channel is null
-            return right_signal
+            return 1
         elif right_sum == 0 and left_sum > 0:
             # right channel is null
-            return left_signal
+            return 0
 
         if left_sum > right_sum:
             # more noise in the left channel
-            return right_signal
+            return 1
         else:
             # more noise in the right channel
-            return left_signal
+            return 0
 
     # return a spectrogram with a sin wave of the given frequency
     def sin_wave(self, frequency):
@@ -129,10 +185,102 @@ class Audio:
         spec = spec / spec.max() # normalize to [0, 1]
         return spec.reshape((1, cfg.audio.spec_height, cfg.audio.spec_width))
 
-    # return list of spectrograms for the given offsets (i.e. starting points in seconds);
+    # return the spectrogram of the segment starting at the given sample for each value in bands, where each value
+    # is a low_band flag, cropped or padded to cfg.audio.spec_width, or None if the start is past the end
+    def _get_segment_spectrograms(self, start, segment_samples, bands):
+        if start >= len(self.signal):
+            return [None for band in bands]
+
+        specs = []
+        for spec in self._get_raw_spectrograms(self.signal[start:start + segment_samples], bands):
+            spec = spec[:cfg.audio.spec_height, :cfg.audio.spec_width]
+            if spec.shape[1] < cfg.audio.spec_width:
+                spec = np.pad(spec, ((0, 0), (0, cfg.audio.spec_width - spec.shape[1])), 'constant', constant_values=0)
+
+            specs.append(spec)
+
+        return specs
+
+    # Compute one spectrogram per block of up to cfg.audio.spec_block_seconds and slice the spectrogram
+    # for each offset from it, so overlapping audio is only transformed once. The per-segment path pads
+    # each segment by reflection, whereas frames sliced from a block see the adjacent audio, so the first
+    # and last n_fft / (2 * hop_length) frames of each segment (8 by default) are recomputed from the
+    # segment's own edges, in one batch per block. Segments that don't start on a block frame, or are cut
+    # short by the end of the signal, are computed as in the per-segment path. Results therefore match
+    # the per-segment path to float32 precision.
+    # Segments are given by their start samples, and a list of spectrograms is returned per value in bands,
+    # where each value is a low_band flag.
+    def _get_block_spectrograms(self, starts, segment_samples, bands):
+        hop_length = cfg.audio.hop_length
+        block_samples = cfg.audio.spec_block_seconds * cfg.audio.sampling_rate
+        signal_len = len(self.signal)
+
+        # frames of a full segment whose window reaches past either end of it, and the samples needed to recompute them
+        n_fft = self.linear_transform.n_fft
+        edge_frames = int(math.ceil(n_fft / (2 * hop_length)))
+        last_frame = segment_samples // hop_length
+        num_frames = min(cfg.audio.spec_width, last_frame + 1)
+        prefix_samples = (edge_frames - 1) * hop_length + n_fft // 2
+        suffix_start = (last_frame - 2 * edge_frames + 1) * hop_length
+
+        spec_lists = [[None for i in range(len(starts))] for band in bands]
+        i = 0
+        while i < len(starts):
+            block_start = starts[i]
+            if block_start >= signal_len:
+                i += 1
+                continue
+
+            # group consecutive segments that fit in one block
+            j = i + 1
+            while j < len(starts) and starts[j] < signal_len and 0 <= starts[j] - starts[i] < block_samples:
+                j += 1
+
+            block_end = min(signal_len, max(starts[i:j]) + segment_samples)
+            block_specs = self._get_raw_spectrograms(self.signal[block_start:block_end], bands)
+
+            patched = [] # indexes of segments sliced from the block
+            for k in range(i, j):
+                end = min(signal_len, starts[k] + segment_samples)
+                if suffix_start >= 0 and (starts[k] - block_start) % hop_length == 0 and end - starts[k] == segment_samples:
+                    patched.append(k)
+                else:
+                    for specs, spec in zip(spec_lists, self._get_segment_spectrograms(starts[k], segment_samples, bands)):
+                        specs[k] = spec
+
+            if len(patched) == 0:
+                i = j
+                continue
+
+            patched_starts = [starts[k] for k in patched]
+            prefix_specs = self._get_raw_spectrograms(np.stack([self.signal[start:start + prefix_samples] for start in patched_starts]), bands)
+            suffix_specs = self._get_raw_spectrograms(np.stack([self.signal[start + suffix_start:start + segment_samples] for start in patched_starts]), bands)
+            for specs, block_spec, prefix_spec, suffix_spec in zip(spec_lists, block_specs, prefix_specs, suffix_specs):
+                block_spec = block_spec[:cfg.audio.spec_height]
+                prefix_spec = prefix_spec[:, :cfg.audio.spec_height, :edge_frames]
+                suffix_spec = suffix_spec[:, :cfg.audio.spec_height, edge_frames:2 * edge_frames]
+
+                for n, (k, start) in enumerate(zip(patched, patched_starts)):
+                    start_frame = (start - block_start) // hop_length
+                    middle = block_spec[:, start_frame + edge_frames:start_frame + last_frame - edge_frames + 1]
+                    spec = np.concatenate([prefix_spec[n], middle, suffix_spec[n]], axis=1)[:, :num_frames]
+                    if spec.shape[1] < cfg.audio.spec_width:
+                        spec = np.pad(spec, ((0, 0), (0, cfg.audio.spec_width - spec.shape[1])), 'constant', constant_values=0)
+
+                    specs[k] = spec
+
+            i = j
+
+        return spec_lists
+
+    # return list of spectrograms for the given offsets (i.e. starting points in seconds, or sample indexes
+    # into the signal if in_samples=True, which avoids rounding errors for fractional offsets);
     # you have to call load() before calling this;
-    # if raw_spectrograms array is specified, populate it with spectrograms before normalization
-    def get_spectrograms(self, offsets, segment_len=None, low_band=False, raw_spectrograms=None):
+    # if raw_spectrograms array is specified, populate it with spectrograms before normalization;
+    # if from_blocks=True, compute spectrograms a block at a time and slice the segments from them
+    # (faster when offsets overlap, and the same to float32 precision);
+    # if low_band_specs array is specified, also populate it with low band spectrograms in the same pass
+    def get_spectrograms(self, offsets, segment_len=None, low_band=False, raw_spectrograms=None, from_blocks=False, low_band_specs=None, in_samples=False):
         logging.debug(f"Audio::get_spectrograms offsets={offsets}")
         if not self.have_signal:
             return None
@@ -142,17 +290,22 @@ class Audio:
             # since cfg.audio.segment_len can be modified after the parameter list is evaluated
             segment_len = cfg.audio.segment_len
 
-        specs = []
         sr = cfg.audio.sampling_rate
-        for i, offset in enumerate(offsets):
-            if int(offset*sr) < len(self.signal):
-                spec = self._get_raw_spectrogram(self.signal[int(offset*sr):int((offset+segment_len)*sr)], low_band=low_band)
-                spec = spec[:cfg.audio.spec_height, :cfg.audio.spec_width]
-                if spec.shape[1] < cfg.audio.spec_width:
-                    spec = np.pad(spec, ((0, 0), (0, cfg.audio.spec_width - spec.shape[1])), 'constant', constant_values=0)
-                specs.append(spec)
-            else:
-                specs.append(None)
+        starts = offsets if in_samples else [int(round(offset * sr)) for offset in offsets]
+        segment_samples = int(segment_len * sr)
+        bands = [low_band] if low_band_specs is None else [low_band, True]
+        if from_blocks:
+            spec_lists = self._get_block_spectrograms(starts, segment_samples, bands)
+        else:
+            spec_lists = [[] for band in bands]
+            for start in starts:
+                for specs, spec in zip(spec_lists, self._get_segment_spectrograms(start, segment_samples, bands)):
+                    specs.append(spec)
+
+        specs = spec_lists[0]
+        if low_band_specs is not None and len(low_band_specs) == len(specs):
+            self._normalize(spec_lists[1])
+            low_band_specs[:] = spec_lists[1]
 
         if raw_spectrograms is not None and len(raw_spectrograms) == len(specs):
             for i, spec in enumerate(specs):
@@ -162,32 +315,99 @@ class Audio:
 
         return specs
 
+    # Return spectrogram strips covering the segments at the given offsets, for MainModel.get_strip_logits.
+    # Consecutive offsets are grouped so each strip covers up to strip_seconds, and strips are padded with zeros
+    # to the same width, a multiple of cfg.audio.spec_width, so they can be batched. Also return the strip index
+    # and start frame of each segment. Each frame is normalized by the max of the segment whose middle it's in,
+    # so the middle of each segment is normalized as in get_spectrograms, but the rest may not be.
+    # As in get_spectrograms, offsets are in seconds, or sample indexes if in_samples=True.
+    def get_strips(self, offsets, strip_seconds, in_samples=False):
+        sr = cfg.audio.sampling_rate
+        hop_length = cfg.audio.hop_length
+        width = cfg.audio.spec_width
+        segment_samples = int(cfg.audio.segment_len * sr)
+        strip_samples = strip_seconds * sr
+        signal_len = len(self.signal)
+
+        starts = offsets if in_samples else [int(round(offset * sr)) for offset in offsets]
+        strip_list, strip_index, start_frames = [], np.zeros(len(starts), dtype=int), np.zeros(len(starts), dtype=int)
+        i = 0
+        while i < len(starts):
+            j = i + 1
+            while j < len(starts) and starts[j] - starts[i] + segment_samples <= strip_samples:
+                j += 1
+
+            strip_start = starts[i]
+            strip_end = min(signal_len, starts[j - 1] + segment_samples)
+            frames = np.array([int(round((start - strip_start) / hop_length)) for start in starts[i:j]])
+            strip = np.zeros((cfg.audio.spec_height, frames[-1] + width), dtype=np.float32)
+            if strip_start < strip_end:
+                raw_spec = self._get_raw_spectrogram(self.signal[strip_start:strip_end])[:cfg.audio.spec_height, :strip.shape[1]]
+                strip[:, :raw_spec.shape[1]] = raw_spec # frames past the end of the signal stay zero, as in get_spectrograms
+
+            segment_max = np.array([strip[:, frame:frame + width].max() for frame in frames])
+            middles = frames + width // 2
+            nearest = np.searchsorted((middles[1:] + middles[:-1]) / 2, np.arange(strip.shape[1]), side='right')
+            divisor = np.where(segment_max[nearest] > 0, segment_max[nearest], 1)
+            strip_list.append((strip / divisor).clip(0, 1))
+
+            strip_index[i:j] = len(strip_list) - 1
+            start_frames[i:j] = frames
+            i = j
+
+        strip_width = width * math.ceil(max([strip.shape[1] for strip in strip_list], default=width) / width)
+        strips = np.zeros((len(strip_list), 1, cfg.audio.spec_height, strip_width), dtype=np.float32)
+        for k, strip in enumerate(strip_list):
+            strips[k, 0, :, :strip.shape[1]] = strip
+
+        return strips, strip_index, start_frames
+
+    # use a signal that was loaded elsewhere (e.g. by another Audio object)
+    def set_signal(self, signal):
+        self.signal = signal
+        self.have_signal = signal is not None
+
     def signal_len(self):
         return len(self.signal) if self.have_signal else 0
 
-    # if logging level is DEBUG, librosa.load generates a lot of output,
-    # so temporarily update level
-    def _call_librosa_load(self, path, mono):
-        saved_log_level = logging.root.level
-        logging.root.setLevel(logging.ERROR)
-        signal, sr = librosa.load(path, sr=cfg.audio.sampling_rate, mono=mono)
-        logging.root.setLevel(saved_log_level)
+    # load a recording and return its spectrograms as one array for a model, for segments every increment seconds
+    # (with the usual inference overlap by default), or None if it can't be read; if low_band=True, also return
+    # an array of low band spectrograms
+    def get_recording_specs(self, path, increment=None, low_band=False):
+        signal, rate = self.load(path)
+        if not self.have_signal:
+            return None
 
-        return signal, sr
+        if increment is None:
+            increment = cfg.audio.segment_len - cfg.infer.spec_overlap_seconds
 
-    def load(self, path):
+        offsets = np.arange(0, max(0, len(signal) / rate - cfg.audio.segment_len) + 1.0, increment).tolist()
+        low_band_specs = [0 for offset in offsets] if low_band else None
+        specs = get_spec_array(self.get_spectrograms(offsets, from_blocks=cfg.infer.spec_from_blocks, low_band_specs=low_band_specs), cfg.audio.spec_height)
+        if low_band:
+            return specs, get_spec_array(low_band_specs, cfg.audio.low_band_spec_height)
+
+        return specs
+
+    # load a recording, or part of one if offset and duration are specified (in seconds);
+    # if channel is specified, use that channel of a stereo recording rather than choosing one;
+    # otherwise the channel is chosen from just the first check_seconds of the recording (not of the
+    # requested span, so every span of a recording gets the same channel), and only the chosen channel
+    # is resampled and kept
+    def load(self, path, offset=0.0, duration=None, channel=None):
         try:
             self.have_signal = True
             self.path = path
+            self.channel = None
 
-            if cfg.audio.choose_channel:
-                self.signal, _ = self._call_librosa_load(path, mono=False)
+            if cfg.audio.choose_channel and channel is None:
+                check_signal, _ = self.decoder.load(path, mono=False, duration=cfg.audio.check_seconds)
+                logging.debug(f"Audio::load check_signal.shape={check_signal.shape}")
+                if len(check_signal.shape) == 2:
+                    channel = self._choose_channel(check_signal)
 
-                logging.debug(f"Audio::load signal.shape={self.signal.shape}")
-                if len(self.signal.shape) == 2:
-                    self.signal = self._choose_channel(self.signal[0], self.signal[1])
-            else:
-                self.signal, _ = self._call_librosa_load(path, mono=True)
+            self.channel = channel
+            self.signal, _ = self.decoder.load(path, offset=offset, duration=duration, channel=channel)
 
         except Exception as e:
             self.have_signal = False
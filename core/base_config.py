@@ -21,6 +21,9 @@ class Audio:
     mel_scale = True
     power = 1.0
     spec_block_seconds = 240 # max seconds of spectrogram to create at a time (limited by GPU memory)
+    decoders = ['soundfile', 'ffmpeg', 'librosa'] # audio decoders to try in order (see core/decoder.py)
+    resample_quality = 'HQ'  # soxr resampling quality; 'HQ' matches librosa.load, and 'MQ' or 'LQ' are a little faster
+    decode_margin = .25      # when decoding part of a recording, read this many extra seconds on each side to avoid resampling edge effects
 
     # low-frequency audio settings for Ruffed Grouse drumming identifier
     low_band_spec_height = 64
@@ -78,6 +81,11 @@ class Training:
 @dataclass
 class Inference:
     num_threads = 3              # multiple threads improves performance but uses more GPU memory
+    file_order = 'size'          # with multiple threads, process longest files first by 'size' or 'duration', or use 'name' order
+    backend = 'torch'            # 'torch', 'script' for TorchScript, or 'onnx' or 'int8' to run exported (and quantized) models with ONNX Runtime on CPU
+    onnx_threads = 0             # threads per ONNX model (0 = divide the CPU cores among analyzer threads)
+    share_models = True          # with multiple threads, load models once and share them (CPU only when using processes)
+    pipeline_depth = 1           # files queued between decode, spectrogram and model stages (0 = no pipelining)
     spec_overlap_seconds = 1.5   # number of seconds overlap for adjacent 3-second spectrograms
     min_score = 0.75             # only generate labels when score is at least this
     score_exponent = .6          # increase scores so they're more like probabilities
@@ -88,6 +96,19 @@ class Inference:
     file_date_regex = "\\S+_(\\d+)_.*" # regex to extract date from file name (e.g. HNCAM015_20210529_161122.mp3)
     file_date_regex_group = 1    # use group at offset 1
     block_size = 100             # do this many spectrograms at a time to avoid running out of GPU memory
+    cache_path = None            # optional directory for cached inference results, keyed by recording contents
+    cache_max_gb = 20            # evict least recently used results when the cache is bigger than this
+    save_scores = False          # save each recording's score matrix, so labels can be regenerated with relabel.py
+    stream = False               # decode and analyze recordings in windows of cfg.audio.spec_block_seconds to limit memory use
+    cascade = False              # run the smallest model first, and the rest of the ensemble only where it finds a possible label
+    cascade_fraction = .5        # run the rest of the ensemble if any score >= this * min_score with the smallest model
+    adaptive_overlap = False     # run the models on non-overlapping segments first, then on overlapping ones only near possible labels
+    adaptive_fraction = .5       # a possible label is a score >= this * min_score
+    sliding_window = False       # for models that support it, run the backbone once per strip of segments (see MainModel.get_strip_logits)
+    strip_seconds = 60           # max seconds per strip in sliding window mode
+    prescreen = False            # skip the models for segments with no sound well above the noise floor, giving them zero scores
+    prescreen_threshold = 6.0    # a segment is skipped if no spectrogram value is this many times the noise floor for its frequency
+    spec_from_blocks = True      # create spectrograms per cfg.audio.spec_block_seconds and slice segments from them
     frequency_db = "frequency"   # eBird barchart data, i.e. species report frequencies
     all_embeddings = True        # if true, generate embeddings for all spectrograms, otherwise only the labelled ones
 
@@ -136,6 +157,11 @@ class Inference:
 class Miscellaneous:
     main_ckpt_folder = "data/ckpt"      # use an ensemble of all checkpoints in this folder for inference
     low_band_ckpt_path = "data/low_band.ckpt"
+    main_onnx_folder = "data/onnx"      # ONNX versions of the main checkpoints, created by tools/export_onnx.py
+    low_band_onnx_path = "data/low_band.onnx"
+    main_int8_folder = "data/onnx-int8" # int8 versions of the ONNX models, created by tools/quantize.py
+    main_script_folder = "data/script"  # TorchScript versions of the main checkpoints, created by tools/export_script.py
+    low_band_script_path = "data/low_band.pt"
     search_ckpt_path = "data/ckpt-search/custom_efficientnet_5.ckpt" # checkpoint used in searching and clustering
     classes_file = "data/classes.txt"   # list of classes used to generate pickle files
     ignore_file = "data/ignore.txt"     # classes listed in this file are ignored in analysis
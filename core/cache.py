@@ -0,0 +1,130 @@
+# Content-addressed cache of inference results, so recordings that were analyzed before, possibly under
+# a different path, don't have to be decoded or run through the models again. Each entry is an .npz file
+# named by its key, which combines a hash of the recording's bytes with keys for the checkpoints and the
+# settings that affect scores. A SQLite index tracks entry sizes and last use, for LRU eviction.
+# Entries are written to a temporary file and renamed, and index updates are transactions,
+# so several analyzer processes can share a cache directory.
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+# return a hex digest of the given file's contents
+def hash_file(path, chunk_size=1 << 20):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if len(chunk) == 0:
+                break
+
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+class Result_Cache:
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.conn = None
+        self.lock = threading.Lock() # the decode and model stages of an analyzer share a connection
+        try:
+            os.makedirs(path, exist_ok=True)
+            self.conn = sqlite3.connect(os.path.join(path, 'index.db'), timeout=60, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self._create_tables()
+        except (OSError, sqlite3.Error) as e:
+            print(f'Error in cache init: {e}')
+
+    # create tables if they don't exist
+    def _create_tables(self):
+        try:
+            cursor = self.conn.cursor()
+
+            query = '''
+                CREATE TABLE IF NOT EXISTS Entry (
+                    Key TEXT PRIMARY KEY,
+                    Size INTEGER NOT NULL,
+                    LastUsed REAL NOT NULL
+                    )
+            '''
+            cursor.execute(query)
+
+            query = 'CREATE INDEX IF NOT EXISTS idx_last_used ON Entry (LastUsed)'
+            cursor.execute(query)
+
+            self.conn.commit()
+        except sqlite3.Error as e:
+            print(f'Error in cache _create_tables: {e}')
+
+    def close(self):
+        try:
+            self.conn.close()
+        except sqlite3.Error as e:
+            print(f'Error in cache close: {e}')
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], f'{key}.npz')
+
+    # return a dict of arrays for the given key, or None if it isn't cached
+    def get(self, key):
+        try:
+            with np.load(self._entry_path(key)) as data:
+                result = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            return None # not cached, or just evicted by another process
+
+        try:
+            with self.lock:
+                self.conn.execute('UPDATE Entry SET LastUsed = ? WHERE Key = ?', (time.time(), key))
+                self.conn.commit()
+        except sqlite3.Error as e:
+            print(f'Error in cache get: {e}')
+
+        return result
+
+    # store a dict of arrays for the given key, then evict least recently used entries if the cache is too big
+    def put(self, key, arrays):
+        entry_path = self._entry_path(key)
+        temp_path = f'{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+            with open(temp_path, 'wb') as file:
+                np.savez(file, **arrays)
+
+            os.replace(temp_path, entry_path)
+            size = os.path.getsize(entry_path)
+        except OSError as e:
+            print(f'Error in cache put: {e}')
+            return
+
+        try:
+            with self.lock:
+                cursor = self.conn.cursor()
+                cursor.execute('BEGIN IMMEDIATE') # lock the index while checking the total size
+                cursor.execute('INSERT OR REPLACE INTO Entry (Key, Size, LastUsed) Values (?, ?, ?)', (key, size, time.time()))
+                cursor.execute('SELECT SUM(Size) FROM Entry')
+                excess = cursor.fetchone()[0] - self.max_bytes
+                if excess > 0:
+                    cursor.execute('SELECT Key, Size FROM Entry WHERE Key != ? ORDER BY LastUsed', (key,))
+                    evicted = []
+                    for old_key, old_size in cursor.fetchall():
+                        if excess <= 0:
+                            break
+
+                        evicted.append(old_key)
+                        excess -= old_size
+
+                    cursor.executemany('DELETE FROM Entry WHERE Key = ?', [(old_key,) for old_key in evicted])
+                    for old_key in evicted:
+                        if os.path.exists(self._entry_path(old_key)):
+                            os.remove(self._entry_path(old_key))
+
+                self.conn.commit()
+        except (OSError, sqlite3.Error) as e:
+            self.conn.rollback()
+            print(f'Error in cache put: {e}')
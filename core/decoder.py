@@ -0,0 +1,137 @@
+# Decode audio files to float32 signals at cfg.audio.sampling_rate.
+# Decoders are tried in the order given by cfg.audio.decoders:
+#
+#   soundfile: libsndfile, which reads WAV, FLAC, OGG and (with libsndfile 1.1 or later) MP3, and can seek
+#   ffmpeg:    an ffmpeg subprocess writing raw samples to a pipe, for other formats such as M4A
+#   librosa:   librosa.load, which falls back to audioread
+#
+# Each decoder returns samples at the file's native rate, which are then converted to mono if requested
+# and resampled with soxr, as librosa.load does. The resampler for each source rate and channel count is
+# created once and reused, and recordings already at the target rate aren't resampled. With the default
+# resample_quality of 'HQ', the result is the same as librosa.load(path, sr=cfg.audio.sampling_rate).
+
+import json
+import logging
+import math
+import shutil
+import subprocess
+
+import numpy as np
+import soundfile as sf
+import soxr
+
+from core import cfg
+
+BLOCK_FRAMES = 1 << 20 # frames per block when reading one channel of a multi-channel file
+
+class Decoder:
+    def __init__(self):
+        self.resamplers = {} # (source rate, channels) -> soxr.ResampleStream
+
+    # return samples with shape (channels, samples) and the native sampling rate, reading
+    # duration seconds (or to the end if None) from offset seconds; if channel is specified,
+    # a reader may return just that channel of a multi-channel file
+    def _read_soundfile(self, path, offset, duration, channel):
+        with sf.SoundFile(path) as file:
+            rate = file.samplerate
+            start = int(offset * rate)
+            if start > 0:
+                file.seek(min(start, file.frames))
+
+            frames = -1 if duration is None else int(duration * rate)
+            if channel is None or file.channels == 1:
+                samples = file.read(frames, dtype='float32', always_2d=True)
+            else:
+                # read a block at a time and keep one channel, so the others are never held in full
+                blocks = [block[:, channel].copy() for block in file.blocks(blocksize=BLOCK_FRAMES, frames=frames, dtype='float32', always_2d=True)]
+                samples = np.concatenate(blocks).reshape((-1, 1)) if len(blocks) > 0 else np.zeros((0, 1), dtype=np.float32)
+
+        return samples.T, rate
+
+    def _read_ffmpeg(self, path, offset, duration, channel):
+        if shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None:
+            raise RuntimeError('ffmpeg is not installed')
+
+        command = ['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', 'stream=sample_rate,channels', '-of', 'json', path]
+        stream = json.loads(subprocess.run(command, capture_output=True, check=True).stdout)['streams'][0]
+        rate, channels = int(stream['sample_rate']), int(stream['channels'])
+
+        command = ['ffmpeg', '-nostdin', '-v', 'error', '-ss', str(offset)]
+        if duration is not None:
+            command += ['-t', str(duration)]
+
+        command += ['-i', path, '-map', '0:a:0']
+        if channel is not None and channels > 1:
+            command += ['-af', f'pan=mono|c0=c{channel}']
+            channels = 1
+
+        command += ['-f', 'f32le', '-acodec', 'pcm_f32le', '-']
+        output = subprocess.run(command, capture_output=True, check=True).stdout
+        samples = np.frombuffer(output, dtype=np.float32)
+        return samples[:len(samples) - len(samples) % channels].reshape((-1, channels)).T, rate
+
+    def _read_librosa(self, path, offset, duration, channel):
+        import librosa # slow to load on first use, and usually not needed here
+
+        # if logging level is DEBUG, librosa.load generates a lot of output, so temporarily update level
+        saved_log_level = logging.root.level
+        logging.root.setLevel(logging.ERROR)
+        try:
+            samples, rate = librosa.load(path, sr=None, mono=False, offset=offset, duration=duration)
+        finally:
+            logging.root.setLevel(saved_log_level)
+
+        return samples.reshape((-1, samples.shape[-1])), rate
+
+    # resample a (channels, samples) array to cfg.audio.sampling_rate, padding or trimming the result to the
+    # expected length as librosa.resample does
+    def resample(self, samples, rate):
+        if rate == cfg.audio.sampling_rate:
+            return samples
+
+        key = (rate, len(samples))
+        if key not in self.resamplers:
+            self.resamplers[key] = soxr.ResampleStream(rate, cfg.audio.sampling_rate, len(samples), dtype='float32', quality=cfg.audio.resample_quality)
+
+        resampler = self.resamplers[key]
+        resampler.clear()
+        resampled = resampler.resample_chunk(np.ascontiguousarray(samples.T), last=True).reshape((-1, len(samples))).T
+
+        length = int(math.ceil(samples.shape[1] * cfg.audio.sampling_rate / rate))
+        if resampled.shape[1] < length:
+            resampled = np.pad(resampled, ((0, 0), (0, length - resampled.shape[1])))
+
+        return np.ascontiguousarray(resampled[:, :length])
+
+    # return the signal for a file, as an array of samples if mono is True, else with shape (channels, samples)
+    # for a stereo file, and the sampling rate; if channel is specified, return just that channel of a stereo
+    # file, which is then the only one resampled; raise the last decoder's exception if none can read the file;
+    # if offset or duration is specified, only that span (plus cfg.audio.decode_margin seconds on each side,
+    # which absorbs the resampler's edge effects and is then trimmed) is decoded
+    def load(self, path, mono=True, offset=0.0, duration=None, channel=None):
+        # start reading on a whole second, so source samples line up with target samples at any integer rate
+        read_offset = float(max(0, math.floor(offset - cfg.audio.decode_margin)))
+        read_duration = None if duration is None else duration + (offset - read_offset) + cfg.audio.decode_margin
+
+        error = None
+        for name in cfg.audio.decoders:
+            try:
+                samples, rate = getattr(self, f'_read_{name}')(path, read_offset, read_duration, channel)
+                break
+            except Exception as e:
+                logging.debug(f"Decoder {name} failed for {path}: {e}")
+                error = e
+        else:
+            raise error if error is not None else RuntimeError('no decoders specified')
+
+        if channel is not None and len(samples) > 1:
+            samples = samples[channel:channel + 1]
+        elif mono and len(samples) > 1:
+            samples = samples.mean(axis=0, keepdims=True)
+
+        signal = self.resample(samples, rate)
+        # the first sample is the one at round(offset * sampling_rate) in the whole signal, as in Audio.get_spectrograms
+        start = int(round(offset * cfg.audio.sampling_rate)) - int(read_offset) * cfg.audio.sampling_rate
+        end = signal.shape[1] if duration is None else start + int(round(duration * cfg.audio.sampling_rate))
+        signal = signal[:, start:end]
+        return (signal[0] if len(signal) == 1 else signal), cfg.audio.sampling_rate
@@ -5,7 +5,6 @@
 # increase recall, at the cost of some precision and some inference time.
 
 import inspect
-import librosa
 import matplotlib.pyplot as plt
 import numpy as np
 import os
@@ -21,6 +20,7 @@ def sigmoid(x, damp):
 # create a low-pass filter
 def low_pass_filter(start_freq, end_freq, damp):
     # get frequency per spectrogram row
+    import librosa # slow to import, and only needed if filters are used
     frequencies = librosa.mel_frequencies(n_mels=cfg.audio.spec_height,
         fmin=cfg.audio.min_audio_freq,
         fmax=cfg.audio.max_audio_freq)
@@ -53,6 +53,7 @@ def high_pass_filter(start_freq, end_freq, damp):
 # create a band-pass filter
 def band_pass_filter(start_freq, end_freq, damp):
     # get frequency per spectrogram row
+    import librosa # slow to import, and only needed if filters are used
     frequencies = librosa.mel_frequencies(n_mels=cfg.audio.spec_height,
         fmin=cfg.audio.min_audio_freq,
         fmax=cfg.audio.max_audio_freq)
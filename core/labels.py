@@ -0,0 +1,75 @@
+# Generate labels from a per-recording score matrix with array operations, rather than
+# looping over segments and classes in Python.
+
+import numpy as np
+
+from core import cfg
+
+class Label:
+    def __init__(self, class_name, score, start_time, end_time):
+        self.class_name = class_name
+        self.score = score
+        self.start_time = start_time
+        self.end_time = end_time
+
+# Mark segments that qualify as labels for the given columns of the (segments, classes) score matrix,
+# updating the is_label mask (and the scores, when a species is confirmed) in place.
+#
+# A segment qualifies if score >= min_score. If lower_min_if_confirmed, count the seconds where
+# score >= the raised threshold, adding overlap seconds if the previous segment is a label and
+# segment_len seconds otherwise. If that is more than confirmed_if_seconds, the species is
+# confirmed, so segments with score >= the lowered threshold also qualify, and their scores are
+# set to min_score so that is what the label shows.
+def mark_labels(scores, is_label, columns, overlap):
+    if len(columns) == 0:
+        return
+
+    class_scores = scores[:, columns]
+    class_labels = is_label[:, columns] | ((class_scores >= cfg.infer.min_score) & (class_scores != 0)) # check for -p 0 case
+
+    if cfg.infer.lower_min_if_confirmed and cfg.infer.min_score > 0 and len(class_scores) > 0:
+        raised_min_score = cfg.infer.min_score + cfg.infer.raise_min_to_confirm * (1 - cfg.infer.min_score)
+        confirmed = class_labels & (class_scores >= raised_min_score)
+        prev_is_label = np.zeros(class_labels.shape, dtype=bool)
+        prev_is_label[1:] = class_labels[:-1]
+
+        # cumsum adds in segment order, so the totals match a sequential loop exactly
+        seconds = np.where(confirmed, np.where(prev_is_label, overlap, cfg.audio.segment_len), 0.0)
+        seconds = seconds.cumsum(axis=0)[-1]
+
+        lowered_min_score = cfg.infer.lower_min_factor * cfg.infer.min_score
+        lowered = ~class_labels & (class_scores >= lowered_min_score) & (seconds > cfg.infer.confirmed_if_seconds)
+        class_labels |= lowered
+        class_scores[lowered] = cfg.infer.min_score # display it as min_score in the label
+        scores[:, columns] = class_scores
+
+    is_label[:, columns] = class_labels
+
+# Return a list of (column, start_time, end_time, score) for the labels in the given columns, ordered by
+# column and then start time. If merge=True, labels that overlap or touch the previous label of the
+# same class are merged into it, and the merged label gets the max score.
+def get_labels(scores, is_label, offsets, columns, merge):
+    if len(columns) == 0:
+        return []
+
+    # get label positions in column order, then segment order
+    column_idx, segment_idx = np.nonzero(is_label[:, columns].T)
+    if len(segment_idx) == 0:
+        return []
+
+    offsets = np.asarray(offsets, dtype=np.float64)
+    columns = np.asarray(columns)[column_idx]
+    start_times = offsets[segment_idx]
+    end_times = start_times + cfg.audio.segment_len
+    label_scores = scores[segment_idx, columns]
+
+    # find the first label in each run of merged labels
+    is_first = np.ones(len(segment_idx), dtype=bool)
+    if merge:
+        is_first[1:] = (columns[1:] != columns[:-1]) | (start_times[1:] > end_times[:-1])
+
+    first = np.flatnonzero(is_first)
+    last = np.append(first[1:], len(segment_idx)) - 1
+    max_scores = np.maximum.reduceat(label_scores, first)
+
+    return list(zip(columns[first].tolist(), start_times[first].tolist(), end_times[last].tolist(), max_scores.tolist()))
@@ -0,0 +1,90 @@
+# SQLite manifest of recordings processed by analyze.py, so an interrupted run can be resumed.
+# Each recording is stored with its size and modification time when it was processed, and a key
+# identifying the checkpoints and settings used, so it is only skipped if none of those changed.
+
+import os
+import sqlite3
+import threading
+
+DONE = 'done'
+FAILED = 'failed'
+
+class Manifest:
+    def __init__(self, filename, settings_key):
+        self.settings_key = settings_key
+        self.conn = None
+        self.lock = threading.Lock() # the decode and model stages of an analyzer share a connection
+        try:
+            # several analyzer processes update the manifest, so wait for locks rather than failing,
+            # and use write-ahead logging so readers don't block writers
+            self.conn = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self._create_tables()
+        except sqlite3.Error as e:
+            print(f'Error in manifest init: {e}')
+
+    # create tables if they don't exist
+    def _create_tables(self):
+        try:
+            cursor = self.conn.cursor()
+
+            query = '''
+                CREATE TABLE IF NOT EXISTS Recording (
+                    Path TEXT PRIMARY KEY,
+                    Size INTEGER NOT NULL,
+                    MTime REAL NOT NULL,
+                    Settings TEXT NOT NULL,
+                    Status TEXT NOT NULL
+                    )
+            '''
+            cursor.execute(query)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            print(f'Error in manifest _create_tables: {e}')
+
+    def close(self):
+        try:
+            self.conn.close()
+        except sqlite3.Error as e:
+            print(f'Error in manifest close: {e}')
+
+    # return the subset of file_list that still has to be processed, i.e. everything except recordings
+    # that were completed with the current settings and haven't changed since; this reads the manifest
+    # in one query and stats each file once, so it's fast even for very large file lists
+    def get_pending(self, file_list):
+        try:
+            query = '''
+                SELECT Path, Size, MTime FROM Recording WHERE Status = ? AND Settings = ?
+            '''
+            cursor = self.conn.cursor()
+            cursor.execute(query, (DONE, self.settings_key))
+            completed = {path: (size, mtime) for path, size, mtime in cursor.fetchall()}
+        except sqlite3.Error as e:
+            print(f'Error in manifest get_pending: {e}')
+            return file_list
+
+        pending = []
+        for file_path in file_list:
+            key = os.path.abspath(file_path)
+            if key in completed:
+                stat = os.stat(file_path)
+                if completed[key] == (stat.st_size, stat.st_mtime):
+                    continue
+
+            pending.append(file_path)
+
+        return pending
+
+    # record that a recording was processed (status = DONE) or could not be (status = FAILED)
+    def update(self, file_path, status):
+        try:
+            stat = os.stat(file_path)
+            query = '''
+                INSERT OR REPLACE INTO Recording (Path, Size, MTime, Settings, Status) Values (?, ?, ?, ?, ?)
+            '''
+            with self.lock:
+                cursor = self.conn.cursor()
+                cursor.execute(query, (os.path.abspath(file_path), stat.st_size, stat.st_mtime, self.settings_key, status))
+                self.conn.commit()
+        except (OSError, sqlite3.Error) as e:
+            print(f'Error in manifest update: {e}')
@@ -0,0 +1,175 @@
+# Run an ensemble of models on a set of spectrograms and average their predictions.
+
+import numpy as np
+import torch
+
+from core import cfg
+
+class Ensemble:
+    # each model maps a batch of spectrograms to logits (e.g. a MainModel);
+    # models are moved to the device once here and stay there;
+    # the optional low band model is used by get_low_band_predictions
+    def __init__(self, models, device, low_band_model=None):
+        self.models = models
+        self.device = device
+        self.low_band_model = low_band_model
+        self.buffer = None # preallocated block of averaged predictions
+        self.cascade_threshold = None # see set_cascade
+
+        for model in self.models + ([] if low_band_model is None else [low_band_model]):
+            model.to(device)
+            model.eval()
+
+        # on a GPU, run each model in its own CUDA stream so their kernels can overlap;
+        # on a CPU each model already uses all cores, so they run one after another
+        if device == 'cuda' and len(models) > 1:
+            self.streams = [torch.cuda.Stream() for model in models]
+        else:
+            self.streams = None
+
+    # In cascade mode, the smallest model runs first, and the others only run on spectrograms where that model
+    # predicts at least the given threshold for some class (limited to the given class mask, if specified).
+    # Other spectrograms get the first model's predictions, rather than an average that assumes the other models
+    # predicted zero. Model size is the number of parameters, so if that isn't available (e.g. for exported
+    # models) the first model in the list is used. The number of escalated spectrograms is recorded.
+    def set_cascade(self, threshold, class_mask=None):
+        self.cascade_threshold = threshold
+        self.cascade_mask = None if class_mask is None else torch.as_tensor(class_mask, dtype=torch.bool).to(self.device)
+        sizes = [sum(p.numel() for p in model.parameters()) if hasattr(model, 'parameters') else 0 for model in self.models]
+        self.cascade_first = int(np.argmin(sizes)) if min(sizes) > 0 else 0
+        self.num_escalated, self.num_screened = 0, 0
+
+    # return summed sigmoid predictions for a batch of spectrograms using the cascade described above
+    def _get_cascade_predictions(self, torch_specs, out):
+        torch.sigmoid(self.models[self.cascade_first](torch_specs), out=out)
+        first = out if self.cascade_mask is None else out[:, self.cascade_mask]
+        escalate = (first >= self.cascade_threshold).any(dim=1).nonzero()[:, 0]
+        self.num_screened += len(out)
+        self.num_escalated += len(escalate)
+        if len(escalate) == 0:
+            return out
+
+        escalated_specs = torch_specs[escalate]
+        total = out[escalate]
+        for i, model in enumerate(self.models):
+            if i != self.cascade_first:
+                total += model(escalated_specs).sigmoid_()
+
+        out[escalate] = total / len(self.models)
+        return out
+
+    # yield the logits of each model for a batch of spectrograms
+    def _get_logits(self, torch_specs):
+        if self.streams is None:
+            for model in self.models:
+                yield model(torch_specs)
+        else:
+            current_stream = torch.cuda.current_stream()
+            outputs = []
+            for model, stream in zip(self.models, self.streams):
+                stream.wait_stream(current_stream) # wait for the input to be copied
+                with torch.cuda.stream(stream):
+                    outputs.append(model(torch_specs))
+
+            for stream in self.streams:
+                current_stream.wait_stream(stream)
+
+            yield from outputs
+
+    # return the average sigmoid prediction of the models, with shape (len(specs), num_classes);
+    # spectrograms are processed one block at a time to avoid running out of GPU memory,
+    # where block size is cfg.infer.block_size;
+    # if filters is specified, it is an array of per-row multipliers with shape (num_filters, spec_height),
+    # each spectrogram is multiplied by each filter, all the variants are run as one batch, and the
+    # returned shape is (num_filters, len(specs), num_classes)
+    def get_predictions(self, specs, filters=None):
+        num_variants = 1 if filters is None else len(filters)
+        block_size = max(1, cfg.infer.block_size // num_variants) # so batches are no larger than cfg.infer.block_size
+        if filters is not None:
+            torch_filters = torch.as_tensor(filters, dtype=torch.float32).to(self.device)
+            torch_filters = torch_filters.reshape((num_variants, 1, 1, -1, 1)) # broadcast over spectrograms and columns
+
+        predictions = None
+        with torch.no_grad():
+            for start_idx in range(0, len(specs), block_size):
+                end_idx = min(start_idx + block_size, len(specs))
+                torch_specs = torch.as_tensor(specs[start_idx:end_idx], dtype=torch.float32).to(self.device) # shared by all models
+                if filters is not None:
+                    torch_specs = (torch_specs.unsqueeze(0) * torch_filters).reshape((-1,) + torch_specs.shape[1:])
+
+                block_predictions = None
+                if self.cascade_threshold is not None:
+                    num_classes = len(self.models[0].train_class_names)
+                    if self.buffer is None or self.buffer.shape[1] != num_classes:
+                        self.buffer = torch.empty((cfg.infer.block_size, num_classes), dtype=torch.float32, device=self.device)
+
+                    block_predictions = self._get_cascade_predictions(torch_specs, self.buffer[:len(torch_specs)])
+                else:
+                    for logits in self._get_logits(torch_specs):
+                        if block_predictions is None:
+                            if self.buffer is None or self.buffer.shape[1] != logits.shape[1]:
+                                self.buffer = torch.empty((cfg.infer.block_size, logits.shape[1]), dtype=torch.float32, device=self.device)
+
+                            block_predictions = self.buffer[:len(logits)]
+                            torch.sigmoid(logits, out=block_predictions)
+                        else:
+                            block_predictions.add_(logits.sigmoid_())
+
+                    block_predictions.div_(len(self.models))
+                if predictions is None:
+                    predictions = np.empty((num_variants, len(specs), block_predictions.shape[1]), dtype=np.float32)
+
+                predictions[:, start_idx:end_idx] = block_predictions.cpu().numpy().reshape((num_variants, end_idx - start_idx, -1))
+
+        return predictions if filters is not None else predictions[0]
+
+    # Return the average sigmoid prediction of the models for the segments of spectrogram strips from
+    # Audio.get_strips, as in get_predictions. Models that support it run forward_features once per strip
+    # (see MainModel.get_strip_logits), and others run on the per-segment spectrograms in specs.
+    # Strips are processed in blocks with about as many frames as cfg.infer.block_size spectrograms.
+    def get_strip_predictions(self, strips, strip_index, start_frames, specs):
+        strips_per_block = max(1, cfg.infer.block_size * cfg.audio.spec_width // strips.shape[-1])
+        predictions = None
+        with torch.no_grad():
+            for start_idx in range(0, len(strips), strips_per_block):
+                in_block = np.nonzero((strip_index >= start_idx) & (strip_index < start_idx + strips_per_block))[0]
+                torch_strips = torch.as_tensor(strips[start_idx:start_idx + strips_per_block], dtype=torch.float32).to(self.device)
+                torch_specs = None
+                block_predictions = None
+                for model in self.models:
+                    if hasattr(model, 'supports_strips') and model.supports_strips():
+                        logits = model.get_strip_logits(torch_strips, strip_index[in_block] - start_idx, start_frames[in_block])
+                    else:
+                        if torch_specs is None:
+                            torch_specs = torch.as_tensor(specs[in_block], dtype=torch.float32).to(self.device)
+
+                        logits = model(torch_specs)
+
+                    if block_predictions is None:
+                        block_predictions = logits.sigmoid_()
+                    else:
+                        block_predictions.add_(logits.sigmoid_())
+
+                block_predictions.div_(len(self.models))
+                if predictions is None:
+                    predictions = np.empty((len(strip_index), block_predictions.shape[1]), dtype=np.float32)
+
+                predictions[in_block] = block_predictions.cpu().numpy()
+
+        return predictions
+
+    # return softmax predictions of the low band model for an array of low band spectrograms,
+    # one block at a time on the ensemble's device, as in get_predictions
+    def get_low_band_predictions(self, low_band_specs):
+        predictions = np.empty((len(low_band_specs), 0), dtype=np.float32)
+        with torch.no_grad():
+            for start_idx in range(0, len(low_band_specs), cfg.infer.block_size):
+                end_idx = min(start_idx + cfg.infer.block_size, len(low_band_specs))
+                torch_specs = torch.as_tensor(low_band_specs[start_idx:end_idx], dtype=torch.float32).to(self.device)
+                block_predictions = torch.softmax(self.low_band_model(torch_specs), dim=1).cpu().numpy()
+                if predictions.shape[1] == 0:
+                    predictions = np.empty((len(low_band_specs), block_predictions.shape[1]), dtype=np.float32)
+
+                predictions[start_idx:end_idx] = block_predictions
+
+        return predictions
@@ -361,6 +361,49 @@ class MainModel(LightningModule):
 
             return x.cpu().detach().numpy()
 
+    # Return True if get_strip_logits can be used, i.e. if forward_features only has local operations, so the
+    # features for a segment depend only on nearby frames. That's true for the custom DLA and HGNetV2 models,
+    # but not for EfficientNet or MobileNet, which use squeeze-excite, FastViT, whose final_conv block uses
+    # squeeze-excite, or VoVNet, which uses efficient channel attention, since those scale channels by their
+    # mean over the whole input.
+    # Models that were wrapped in a Sequential for transfer learning don't have forward_features.
+    def supports_strips(self):
+        if not hasattr(self.base_model, 'forward_features') or not hasattr(self.base_model, 'forward_head'):
+            return False
+
+        return any(self.model_name.startswith(name) for name in ['custom_dla', 'custom_hgnet'])
+
+    # Return logits for segments of a batch of spectrogram strips from Audio.get_strips, running forward_features
+    # once per strip and forward_head on the features for each segment, so frames shared by overlapping segments
+    # are only processed once. Strip widths must be a multiple of cfg.audio.spec_width, and segment start frames
+    # are rounded to a multiple of the feature stride (32 frames, or 0.25 seconds by default). Features near the
+    # start or end of a segment see the neighbouring frames instead of the zero padding they get when a segment
+    # is processed on its own, so scores differ slightly from those of get_predictions, except for segments that
+    # are alone in a strip. Strip edges are padded as usual.
+    def get_strip_logits(self, strips, strip_index, start_frames):
+        features = self.base_model.forward_features(strips)
+        stride = strips.shape[-1] // features.shape[-1]
+        num_columns = cfg.audio.spec_width // stride
+        start_columns = [int(round(frame / stride)) for frame in start_frames]
+        segment_features = torch.stack([features[i, :, :, column:column + num_columns] for i, column in zip(strip_index, start_columns)])
+        return self.base_model.forward_head(segment_features)
+
+    # get predictions for the segments of spectrogram strips, as in get_predictions
+    def get_strip_predictions(self, strips, strip_index, start_frames, device, use_softmax=False):
+        predictions = []
+        strips_per_block = max(1, cfg.infer.block_size * cfg.audio.spec_width // strips.shape[-1])
+        with torch.no_grad():
+            for start_idx in range(0, len(strips), strips_per_block):
+                in_block = (strip_index >= start_idx) & (strip_index < start_idx + strips_per_block)
+                torch_strips = torch.Tensor(strips[start_idx:start_idx + strips_per_block]).to(device)
+                logits = self.get_strip_logits(torch_strips, strip_index[in_block] - start_idx, start_frames[in_block])
+                if use_softmax:
+                    predictions.append(F.softmax(logits, dim=1).cpu().numpy())
+                else:
+                    predictions.append(torch.sigmoid(logits).cpu().numpy())
+
+        return np.concatenate(predictions) if len(predictions) > 0 else None
+
     # get predictions one block at a time to avoid running out of GPU memory;
     # block size is cfg.infer.block_size
     def get_predictions(self, specs, device, use_softmax=False):
@@ -0,0 +1,80 @@
+# Export models to ONNX, and run exported models with ONNX Runtime's CPU execution provider.
+# OnnxModel has the subset of the MainModel interface used in inference, so it can be used
+# in an Ensemble or as the low band model.
+#
+# These are optional dependencies, which aren't in requirements.txt: running exported models
+# needs onnxruntime, and exporting them also needs onnx.
+
+import inspect
+import json
+
+import numpy as np
+import onnxruntime as ort
+import torch
+
+from core import cfg
+
+# export a MainModel to the given path, storing the class names and codes as metadata
+def export(model, path, spec_height):
+    import onnx
+
+    model.eval()
+    example = torch.zeros((2, 1, spec_height, cfg.audio.spec_width), dtype=torch.float32)
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # newer versions of torch default to the dynamo exporter, but this uses the TorchScript one
+        kwargs['dynamo'] = False
+
+    torch.onnx.export(model.base_model, (example,), path, input_names=['specs'], output_names=['logits'],
+                      dynamic_axes={'specs': {0: 'batch'}, 'logits': {0: 'batch'}}, opset_version=17, **kwargs)
+
+    onnx_model = onnx.load(path)
+    for key, value in [('train_class_names', model.train_class_names), ('train_class_codes', model.train_class_codes)]:
+        entry = onnx_model.metadata_props.add()
+        entry.key, entry.value = key, json.dumps(list(value))
+
+    onnx.save(onnx_model, path)
+
+class OnnxModel:
+    # num_threads is the number of threads used within an operator (0 = ONNX Runtime default, i.e. all cores);
+    # operators run one at a time, since these models are mostly sequential
+    def __init__(self, path, num_threads=0):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+
+        self.session = ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.train_class_names = json.loads(metadata['train_class_names'])
+        self.train_class_codes = json.loads(metadata['train_class_codes'])
+
+    # these are no-ops, so an OnnxModel can be used wherever a MainModel is
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+    def share_memory(self):
+        return self
+
+    # return logits for a batch of spectrograms, as a tensor on the same device as the input
+    def __call__(self, x):
+        logits = self.session.run(None, {self.input_name: x.cpu().numpy()})[0]
+        return torch.from_numpy(logits).to(x.device)
+
+    # get predictions one block at a time, as in MainModel.get_predictions
+    def get_predictions(self, specs, device, use_softmax=False):
+        predictions = []
+        for start_idx in range(0, len(specs), cfg.infer.block_size):
+            block = np.ascontiguousarray(specs[start_idx:start_idx + cfg.infer.block_size], dtype=np.float32)
+            logits = torch.from_numpy(self.session.run(None, {self.input_name: block})[0])
+            if use_softmax:
+                predictions.append(torch.softmax(logits, dim=1).numpy())
+            else:
+                predictions.append(torch.sigmoid(logits).numpy())
+
+        return np.concatenate(predictions) if len(predictions) > 0 else None
@@ -0,0 +1,60 @@
+# Convert models to frozen TorchScript, which loads much faster than a Lightning checkpoint, and
+# run the converted models. Freezing inlines the weights and folds batch norm into the preceding
+# convolutions. The class names and codes are stored in the same file, and loading it doesn't
+# import PyTorch Lightning or timm. ScriptModel has the subset of the MainModel interface used
+# in inference, so it can be used in an Ensemble or as the low band model.
+
+import json
+
+import numpy as np
+import torch
+
+from core import cfg
+
+# convert a MainModel and save it to the given path
+def export(model, path, spec_height):
+    model.eval()
+    example = torch.zeros((2, 1, spec_height, cfg.audio.spec_width), dtype=torch.float32)
+    with torch.no_grad():
+        module = torch.jit.freeze(torch.jit.trace(model.base_model, example))
+
+    extra_files = {'classes.json': json.dumps({'names': list(model.train_class_names), 'codes': list(model.train_class_codes)})}
+    torch.jit.save(module, path, _extra_files=extra_files)
+
+class ScriptModel:
+    def __init__(self, path, device):
+        extra_files = {'classes.json': ''}
+        self.module = torch.jit.load(path, map_location=torch.device(device), _extra_files=extra_files)
+        self.module.eval()
+
+        classes = json.loads(extra_files['classes.json'])
+        self.train_class_names = classes['names']
+        self.train_class_codes = classes['codes']
+
+    def to(self, device):
+        self.module.to(device)
+        return self
+
+    def eval(self):
+        return self
+
+    def share_memory(self):
+        self.module.share_memory()
+        return self
+
+    # return logits for a batch of spectrograms
+    def __call__(self, x):
+        return self.module(x)
+
+    # get predictions one block at a time, as in MainModel.get_predictions
+    def get_predictions(self, specs, device, use_softmax=False):
+        predictions = []
+        with torch.no_grad():
+            for start_idx in range(0, len(specs), cfg.infer.block_size):
+                logits = self.module(torch.as_tensor(specs[start_idx:start_idx + cfg.infer.block_size], dtype=torch.float32).to(device))
+                if use_softmax:
+                    predictions.append(torch.softmax(logits, dim=1).cpu().numpy())
+                else:
+                    predictions.append(torch.sigmoid(logits).cpu().numpy())
+
+        return np.concatenate(predictions) if len(predictions) > 0 else None
@@ -453,8 +453,19 @@ class Analyzer:
 
         self._get_predictions(signal, rate)
 
-        # do pre-processing for individual species
-        self.species_handlers.reset(self.class_infos, self.offsets, self.raw_spectrograms, self.audio, self.check_frequency, self.week_num)
+        # do pre-processing for individual species; the handlers work on numpy arrays
+        for class_info in self.class_infos:
+            class_info.scores = np.array(class_info.scores, dtype=np.float32)
+            class_info.is_label = np.array(class_info.is_label, dtype=bool)
+
+        # the low band model is only needed if a handler uses it, e.g. if RUGR isn't ignored
+        low_band_predictions = None
+        resources = self.species_handlers.get_resources([class_info.code for class_info in self.class_infos if not class_info.ignore])
+        if species_handlers.LOW_BAND in resources:
+            low_band_specs = self.audio.get_spectrograms(offsets=self.offsets, low_band=True)
+            low_band_predictions = self.species_handlers.get_low_band_predictions(low_band_specs)
+
+        self.species_handlers.reset(self.class_infos, self.offsets, self.raw_spectrograms, low_band_predictions, self.check_frequency, self.week_num)
         for class_info in self.class_infos:
             if  not class_info.ignore and class_info.code in self.species_handlers.handlers:
                 self.species_handlers.handlers[class_info.code](class_info)
@@ -0,0 +1,59 @@
+# Generate Audacity label files from score matrices saved by "analyze.py --scores",
+# so different label settings (e.g. min_score or score_exponent) can be explored
+# without loading the models or running inference again.
+
+import argparse
+import logging
+import os
+from pathlib import Path
+import time
+
+from analyze import Analyzer
+from core import cfg
+
+if __name__ == '__main__':
+    # command-line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--band', type=int, default=1 * cfg.infer.use_banding_codes, help=f"If 1, use banding codes labels. If 0, use common names. Default = {1 * cfg.infer.use_banding_codes}.")
+    parser.add_argument('--confirm', type=int, default=cfg.infer.lower_min_if_confirmed, help=f"Specify 0 to disable the second pass that lowers min_score for confirmed species (default = {cfg.infer.lower_min_if_confirmed}).")
+    parser.add_argument('--exponent', type=float, default=cfg.infer.score_exponent, help=f"Score exponent. Default = {cfg.infer.score_exponent}.")
+    parser.add_argument('-i', '--input', type=str, default='', help="Directory containing scores saved by analyze.py --scores. No default.")
+    parser.add_argument('-o', '--output', type=str, default='', help="Output directory to contain label files. Default is the parent of the input directory.")
+    parser.add_argument('-m', '--merge', type=int, default=1, help=f'Specify 0 to not merge adjacent labels of same species. Default = 1, i.e. merge.')
+    parser.add_argument('-p', '--min_score', type=float, default=cfg.infer.min_score, help=f"Generate label if score >= this. Default = {cfg.infer.min_score}.")
+
+    # arguments for location/date processing
+    parser.add_argument('--date', type=str, default=None, help=f'Date in yyyymmdd, mmdd, or file. Specifying file extracts the date from the file name, using the file_date_regex in base_config.py.')
+    parser.add_argument('--lat', type=float, default=None, help=f'Latitude. Use with longitude to identify an eBird county and ignore corresponding rarities.')
+    parser.add_argument('--lon', type=float, default=None, help=f'Longitude. Use with latitude to identify an eBird county and ignore corresponding rarities.')
+    parser.add_argument('--filelist', type=str, default=None, help=f'Path to optional CSV file containing input file names, latitudes, longitudes and recording dates.')
+    parser.add_argument('--region', type=str, default=None, help=f'eBird region code, e.g. "CA-AB" for Alberta. Use as an alternative to latitude/longitude.')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s.%(msecs)03d %(message)s', datefmt='%H:%M:%S')
+    start_time = time.time()
+
+    if not os.path.isdir(args.input):
+        logging.error(f"Error: {args.input} is not a directory")
+        quit()
+
+    cfg.infer.use_banding_codes = args.band
+    cfg.infer.lower_min_if_confirmed = args.confirm
+    cfg.infer.score_exponent = args.exponent
+    cfg.infer.min_score = args.min_score
+    if cfg.infer.min_score < 0:
+        logging.error("Error: min_score must be >= 0")
+        quit()
+
+    output_path = args.output if len(args.output) > 0 else str(Path(args.input).resolve().parent)
+
+    # the overlap is taken from the saved offsets, so the one given here is ignored
+    analyzer = Analyzer(args.input, output_path, '', '', args.date, args.lat, args.lon, args.region,
+                        args.filelist, False, args.merge, cfg.infer.spec_overlap_seconds, 'cpu')
+    analyzer.relabel(args.input)
+
+    elapsed = time.time() - start_time
+    minutes = int(elapsed) // 60
+    seconds = int(elapsed) % 60
+    logging.info(f"Elapsed time = {minutes}m {seconds}s")
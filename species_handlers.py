@@ -1,5 +1,5 @@
 # Species-specific inference logic.
-# To disable or add a handler, update self.handlers in the constructor below.
+# To disable or add a handler, update HANDLERS below.
 
 import os
 from types import SimpleNamespace
@@ -8,88 +8,105 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 
+from core import audio
 from core import cfg
-from model import main_model
+
+# resources that handlers may need, which are expensive to compute so they're only computed if needed
+LOW_BAND = 'low_band'                 # low band model predictions
+RAW_SPECTROGRAMS = 'raw_spectrograms' # spectrograms before normalization
+
+# Handler registry, mapping class codes to the name of a Species_Handlers method and its parameters,
+# so it's easy to use the same logic for multiple species. Each handler works on whole score columns,
+# so adding a species here doesn't add any per-segment work.
+HANDLERS = {
+    'BOOW': ('soundalike_with_location', dict(soundalike_code='WISN', min_score=.1, min_common=.005, max_rare=.0001)),
+    'BWHA': ('soundalike_no_location', dict(soundalike_code='WTSP', min_score=.25)),
+    'CBCH': ('soundalike_with_location', dict(soundalike_code='BCCH', min_score=0, min_common=.1, max_rare=.0001)),
+    #'LALO': ('amplitude', dict(low_freq=.49, high_freq=.69, min_ratio=.15)),
+    'MOCH': ('soundalike_with_location', dict(soundalike_code='BCCH', min_score=0, min_common=.1, max_rare=.0001)),
+    'NOPO': ('soundalike_with_location', dict(soundalike_code='CORA', min_score=.1, min_common=.005, max_rare=.0001)),
+    #'PIGR': ('amplitude', dict(low_freq=.46, high_freq=.56, min_ratio=.15)),
+    'RUGR': ('ruffed_grouse', dict()),
+    'YTWA': ('soundalike_with_location', dict(soundalike_code='SWSP', min_score=.1, min_common=.005, max_rare=.0001)),
+}
+
+# resources needed by each handler, if any
+HANDLER_RESOURCES = {
+    'amplitude': [RAW_SPECTROGRAMS],
+    'ruffed_grouse': [LOW_BAND],
+}
 
 class Species_Handlers:
-    def __init__(self, device):
-        # update this dictionary to enable/disable handlers
-        self.handlers = {
-            'BOOW': self.soundalike_with_location,
-            'BWHA': self.soundalike_no_location,
-            'CBCH': self.soundalike_with_location,
-            #'LALO': self.amplitude,
-            'MOCH': self.soundalike_with_location,
-            'NOPO': self.soundalike_with_location,
-            #'PIGR': self.amplitude,
-            'RUGR': self.ruffed_grouse,
-            'YTWA': self.soundalike_with_location,
-        }
-
-        # handler parameters, so it's easy to use the same logic for multiple species
-        self.amplitude_config = {
-            'LALO': SimpleNamespace(low_freq=.49, high_freq=.69, min_ratio=.15),
-            'PIGR': SimpleNamespace(low_freq=.46, high_freq=.56, min_ratio=.15),
-        }
-
-        # for the soundalike_no_location case
-        self.soundalike_no_location_config = {
-            'BWHA': SimpleNamespace(soundalike_code='WTSP', min_score=.25)
-        }
-
-        # for the soundalike_with_location case
-        self.soundalike_with_location_config = {
-            'BOOW': SimpleNamespace(soundalike_code='WISN', min_score=.1, min_common=.005, max_rare=.0001),
-            'CBCH': SimpleNamespace(soundalike_code='BCCH', min_score=0, min_common=.1, max_rare=.0001),
-            'MOCH': SimpleNamespace(soundalike_code='BCCH', min_score=0, min_common=.1, max_rare=.0001),
-            'NOPO': SimpleNamespace(soundalike_code='CORA', min_score=.1, min_common=.005, max_rare=.0001),
-            'YTWA': SimpleNamespace(soundalike_code='SWSP', min_score=.1, min_common=.005, max_rare=.0001),
-        }
+    def __init__(self, device, low_band_model=None):
+        # map class codes to bound handler methods, and keep the parameters for each class
+        self.handlers = {}
+        self.config = {}
+        for code, (name, params) in HANDLERS.items():
+            self.handlers[code] = getattr(self, name)
+            self.config[code] = SimpleNamespace(**params)
 
         self.device = device
-        self.low_band_model = None
+        self.low_band_model = low_band_model
+
+    # Return the set of resources needed by enabled handlers for the given class codes,
+    # which should exclude ignored classes
+    def get_resources(self, class_codes):
+        resources = set()
+        for code in class_codes:
+            if code in self.handlers:
+                resources.update(HANDLER_RESOURCES.get(self.handlers[code].__name__, []))
+
+        return resources
 
     # Prepare for next recording
-    def reset(self, class_infos, offsets, raw_spectrograms, audio, check_frequency, week_num):
+    def reset(self, class_infos, offsets, raw_spectrograms, low_band_predictions, check_frequency, week_num):
         self.class_infos = {}
         for class_info in class_infos:
             self.class_infos[class_info.code] = class_info
 
         self.offsets = offsets
         self.raw_spectrograms = raw_spectrograms
+        self.raw_spectrogram_array = None
         self.highest_amplitude = None
         self.check_frequency = check_frequency  # if true, we're checking eBird frequency for given county/week
         self.week_num = week_num                # for when check_frequency = True
-        self.low_band_specs = audio.get_spectrograms(offsets=offsets, low_band=True)
+        self.low_band_predictions = low_band_predictions
 
+    # Return low band model predictions for a list of low band spectrograms.
+    # This is called per batch of spectrograms (e.g. per window in streaming mode), so the
+    # spectrograms don't have to be kept until the whole recording has been processed.
+    def get_low_band_predictions(self, low_band_specs):
         if self.low_band_model is None:
+            from model import main_model # slow to import, and usually not needed here
             self.low_band_model = main_model.MainModel.load_from_checkpoint(cfg.misc.low_band_ckpt_path, map_location=torch.device(self.device))
             self.low_band_model.eval() # set inference mode
 
+        spec_array = audio.get_spec_array(low_band_specs, cfg.audio.low_band_spec_height)
+        with torch.no_grad():
+            return self.low_band_model.get_predictions(spec_array, self.device, use_softmax=True)
+
     # Handle cases where a faint vocalization is mistaken for another species.
     # For example, distant songs of American Robin and similar-sounding species are sometimes mistaken for Pine Grosbeak,
     # so we ignore Pine Grosbeak sounds that are too quiet.
     def amplitude(self, class_info):
-        if not class_info.has_label:
-            return
+        if not class_info.has_label or self.raw_spectrograms is None:
+            return # raw spectrograms aren't kept in streaming mode
 
-        config = self.amplitude_config[class_info.code]
+        config = self.config[class_info.code]
         low_index = int(config.low_freq * cfg.audio.spec_height)   # bottom of frequency range
         high_index = int(config.high_freq * cfg.audio.spec_height) # top of frequency range
 
-        for i in range(len(class_info.scores)):
-            # ignore if score < threshold
-            if class_info.scores[i] < cfg.infer.min_score:
-                continue
+        # set score = 0 if score >= min_score and relative amplitude is too low
+        above = class_info.scores >= cfg.infer.min_score
+        if not above.any():
+            return
 
-            # don't get this until we need it, since it's expensive to calculate the first time
-            highest_amplitude = self.get_highest_amplitude()
+        raw_spectrograms = self.get_raw_spectrogram_array()
+        amplitude = raw_spectrograms[:, low_index:high_index, :].max(axis=(1, 2))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative_amplitude = amplitude / self.get_highest_amplitude()
 
-            # set score = 0 if relative amplitude is too low
-            amplitude = np.max(self.raw_spectrograms[i][low_index:high_index,:])
-            relative_amplitude = amplitude / highest_amplitude
-            if relative_amplitude < config.min_ratio:
-                class_info.scores[i] = 0
+        class_info.scores[above & (relative_amplitude < config.min_ratio)] = 0
 
     # Handle cases where one species is frequently mistaken for another, independently of location/date processing.
     # For example, a fragment of a White-throated Sparrow song is sometimes mistaken for a Broad-winged Hawk.
@@ -98,19 +115,16 @@ class Species_Handlers:
         if not class_info.has_label:
             return
 
-        config = self.soundalike_no_location_config[class_info.code]
+        config = self.config[class_info.code]
         if config.soundalike_code not in self.class_infos:
             return # must be using a subset of the full species list
 
         soundalike_info = self.class_infos[config.soundalike_code] # class_info for the soundalike species
-        for i in range(len(class_info.scores)):
-            # ignore if score < threshold
-            if class_info.scores[i] < cfg.infer.min_score:
-                continue
 
-            # set score = 0 if current or previous soundalike score >= min_score
-            if soundalike_info.scores[i] >= config.min_score or (i > 0 and soundalike_info.scores[i - 1] >= config.min_score):
-                class_info.scores[i] = 0
+        # set score = 0 if score >= min_score and current or previous soundalike score >= config.min_score
+        soundalike = soundalike_info.scores >= config.min_score
+        soundalike[1:] |= soundalike[:-1].copy()
+        class_info.scores[(class_info.scores >= cfg.infer.min_score) & soundalike] = 0
 
     # Handle cases where one species is frequently mistaken for another, using location/date processing.
     # This handles cases where a relatively common species is sometimes misidentified as a rare one.
@@ -121,60 +135,63 @@ class Species_Handlers:
         if not self.check_frequency or not class_info.has_label:
             return
 
-        config = self.soundalike_with_location_config[class_info.code]
+        config = self.config[class_info.code]
         if config.soundalike_code not in self.class_infos:
             return # must be using a subset of the full species list
 
         soundalike_info = self.class_infos[config.soundalike_code] # class_info for the soundalike species
-        for i in range(len(class_info.scores)):
-            # ignore if score < threshold
-            if class_info.scores[i] < cfg.infer.min_score:
-                continue
-
-            # if it is rare and the soundalike is common, and soundalike seems possible given score, identify it as the soundalike
-            if soundalike_info.scores[i] >= config.min_score and soundalike_info.scores[i] < class_info.scores[i]:
-                if self.week_num is None:
-                    # no date specified, so use max eBird frequency across all weeks
-                    class_frequency = class_info.max_frequency
-                    soundalike_frequency = soundalike_info.max_frequency
-                else:
-                    class_frequency = class_info.frequency[self.week_num]
-                    soundalike_frequency = soundalike_info.frequency[self.week_num]
-
-                if soundalike_frequency >= config.min_common and class_frequency <= config.max_rare:
-                    # soundalike species (e.g. WISN) is common and class species (e.g. BOOW) is rare,
-                    # and soundalike score is below class_info and above config.min_score, so change it to the soundalike
-                    soundalike_info.scores[i] = class_info.scores[i]
-                    soundalike_info.is_label[i] = True
-                    soundalike_info.has_label = True
-                    class_info.scores[i] = 0
+        if self.week_num is None:
+            # no date specified, so use max eBird frequency across all weeks
+            class_frequency = class_info.max_frequency
+            soundalike_frequency = soundalike_info.max_frequency
+        else:
+            class_frequency = class_info.frequency[self.week_num]
+            soundalike_frequency = soundalike_info.frequency[self.week_num]
+
+        if soundalike_frequency < config.min_common or class_frequency > config.max_rare:
+            return # soundalike species is not common enough or class species is not rare enough
+
+        # soundalike species (e.g. WISN) is common and class species (e.g. BOOW) is rare,
+        # so where score >= min_score and soundalike score is below it and above config.min_score,
+        # change it to the soundalike
+        scores, soundalike_scores = class_info.scores, soundalike_info.scores
+        change = (scores >= cfg.infer.min_score) & (soundalike_scores >= config.min_score) & (soundalike_scores < scores)
+        if change.any():
+            soundalike_scores[change] = scores[change]
+            soundalike_info.is_label[change] = True
+            soundalike_info.has_label = True
+            scores[change] = 0
 
     # Use the low band spectrogram and model to check for Ruffed Grouse drumming.
     # The frequency is too low to detect properly with the normal spectrogram,
     # and splitting it helps to keep low frequency noise out of the latter.
     def ruffed_grouse(self, class_info):
-        spec_array = np.zeros((len(self.low_band_specs), 1, cfg.audio.low_band_spec_height, cfg.audio.spec_width))
-        for i in range(len(self.low_band_specs)):
-            spec_array[i] = self.low_band_specs[i].reshape((1, cfg.audio.low_band_spec_height, cfg.audio.spec_width)).astype(np.float32)
-
-        with torch.no_grad():
-            predictions = self.low_band_model.get_predictions(spec_array, self.device, use_softmax=True)
-
-            # merge with main predictions (drumming is detected here, other RUGR sounds are detected by the main ensemble)
-            exponent = 1.7 # lower the drumming predictions a bit to reduce false positives
-            for i in range(len(self.offsets)):
-                class_info.scores[i] = max(class_info.scores[i], predictions[i][0] ** exponent)
-                if class_info.scores[i] >= cfg.infer.min_score:
-                    class_info.has_label = True
+        if self.low_band_predictions is None:
+            return # not available, e.g. in saved scores from a run where RUGR was ignored
+
+        # merge with main predictions (drumming is detected here, other RUGR sounds are detected by the main ensemble)
+        exponent = 1.7 # lower the drumming predictions a bit to reduce false positives
+        np.maximum(class_info.scores, self.low_band_predictions[:, 0] ** exponent, out=class_info.scores)
+        if (class_info.scores >= cfg.infer.min_score).any():
+            class_info.has_label = True
+
+    # Return the raw spectrograms as one array, creating it the first time it's needed for a recording.
+    # Missing spectrograms (past the end of the recording) are zero.
+    def get_raw_spectrogram_array(self):
+        if self.raw_spectrogram_array is None:
+            shape = next((spec.shape for spec in self.raw_spectrograms if spec is not None), (cfg.audio.spec_height, cfg.audio.spec_width))
+            self.raw_spectrogram_array = np.zeros((len(self.raw_spectrograms),) + shape, dtype=np.float32)
+            for i, spec in enumerate(self.raw_spectrograms):
+                if spec is not None:
+                    self.raw_spectrogram_array[i] = spec
+
+        return self.raw_spectrogram_array
 
     # Return the highest amplitude from the raw spectrograms.
     # Since they overlap, just check every 3rd one.
     # Skip the very lowest frequencies, which often contain loud noise.
     def get_highest_amplitude(self):
         if self.highest_amplitude is None:
-            self.highest_amplitude = 0
-            for i in range(0, len(self.raw_spectrograms), 3):
-                curr_max = np.max(self.raw_spectrograms[i][5:,:])
-                self.highest_amplitude = max(self.highest_amplitude, curr_max)
+            self.highest_amplitude = max(0, self.get_raw_spectrogram_array()[::3, 5:, :].max(initial=0))
 
         return self.highest_amplitude
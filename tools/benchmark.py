@@ -0,0 +1,605 @@
+# Benchmarks for inference performance work. Each mode compares a new code path with the one it replaces,
+# reporting elapsed time and how closely the results match. Run it from the tools directory, e.g.
+#
+#   python benchmark.py ensemble
+#
+# to compare the old loop in Analyzer._call_models with model.ensemble.Ensemble for 1, 3 and 5 checkpoints.
+
+import argparse
+import glob
+import inspect
+import os
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+# this is necessary before importing from a peer directory
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from core import audio
+from core import cfg
+from core import filters
+from core import labels
+from core import util
+from model import ensemble
+from model import main_model
+
+# return models loaded from the main checkpoint folder
+def get_models(device):
+    model_paths = sorted(glob.glob(os.path.join("..", cfg.misc.main_ckpt_folder, "*.ckpt")))
+    if len(model_paths) == 0:
+        print(f"Error: no checkpoints found in ../{cfg.misc.main_ckpt_folder}")
+        quit()
+
+    models = []
+    for model_path in model_paths:
+        model = main_model.MainModel.load_from_checkpoint(model_path, map_location=torch.device(device))
+        model.eval()
+        models.append(model)
+
+    return models
+
+# print elapsed time for both code paths and the difference in their predictions
+def report(name, old_seconds, new_seconds, old_predictions, new_predictions):
+    max_diff = np.abs(old_predictions - new_predictions).max()
+    print(f"{name}: old={old_seconds:.3f}s, new={new_seconds:.3f}s, speedup={old_seconds / new_seconds:.2f}x, max difference={max_diff:.6f}")
+
+# compare the per-model loop previously used in Analyzer._call_models with the Ensemble class;
+# if there are fewer than 5 checkpoints, they are reused to make up the numbers
+def benchmark_ensemble(args):
+    device = 'cpu'
+    specs = audio.Audio(device=device).get_recording_specs(args.input)
+    models = get_models(device)
+    print(f"Using {len(specs)} spectrograms from {args.input}")
+
+    for num_models in [1, 3, 5]:
+        members = [models[i % len(models)] for i in range(num_models)]
+
+        start_time = time.time()
+        avg_pred = None
+        for model in members:
+            model.to(device)
+            pred = model.get_predictions(specs, device, use_softmax=False)
+            if avg_pred is None:
+                avg_pred = pred
+            else:
+                avg_pred += pred
+
+        avg_pred /= len(members)
+        old_seconds = time.time() - start_time
+
+        start_time = time.time()
+        predictions = ensemble.Ensemble(members, device).get_predictions(specs)
+        new_seconds = time.time() - start_time
+
+        report(f"{num_models} checkpoint(s)", old_seconds, new_seconds, avg_pred, predictions)
+
+# compare the old approach to low/high/band-pass filters, i.e. a copy and ensemble call per filter followed
+# by a per-element max, with running all filter variants through the ensemble as one batch
+def benchmark_filters(args):
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    specs = audio.Audio(device=device).get_recording_specs(args.input)
+    model = ensemble.Ensemble(get_models(device), device)
+    filter_list = [filters.low_pass_filter(cfg.infer.lpf_start_freq, cfg.infer.lpf_end_freq, cfg.infer.lpf_damp),
+                   filters.high_pass_filter(cfg.infer.hpf_start_freq, cfg.infer.hpf_end_freq, cfg.infer.hpf_damp),
+                   filters.band_pass_filter(cfg.infer.bpf_start_freq, cfg.infer.bpf_end_freq, cfg.infer.bpf_damp)]
+    print(f"Using {len(specs)} spectrograms from {args.input}")
+
+    for num_filters in range(1, len(filter_list) + 1):
+        start_time = time.time()
+        scores = model.get_predictions(specs).tolist()
+        for filter in filter_list[:num_filters]:
+            filtered_specs = specs.copy()
+            for i, spec in enumerate(filtered_specs):
+                spec = spec.reshape((cfg.audio.spec_height, cfg.audio.spec_width))
+                filtered_specs[i] = (spec.T * filter).T
+
+            predictions = model.get_predictions(filtered_specs)
+            for i in range(len(specs)):
+                for j in range(len(scores[i])):
+                    scores[i][j] = max(scores[i][j], predictions[i][j])
+
+        old_seconds = time.time() - start_time
+
+        start_time = time.time()
+        variants = np.array([np.ones(cfg.audio.spec_height)] + filter_list[:num_filters], dtype=np.float32)
+        predictions = model.get_predictions(specs, variants).max(axis=0)
+        new_seconds = time.time() - start_time
+
+        report(f"{num_filters} filter(s)", old_seconds, new_seconds, np.array(scores), predictions)
+
+# compare the PyTorch ensemble with the ONNX Runtime versions created by export_onnx.py, on CPU;
+# this reports the throughput of each and the max difference in ensemble predictions
+def benchmark_onnx(args):
+    from model import onnx_model
+
+    device = 'cpu'
+    specs = audio.Audio(device=device).get_recording_specs(args.input)
+    onnx_paths = sorted(glob.glob(os.path.join("..", cfg.misc.main_onnx_folder, "*.onnx")))
+    if len(onnx_paths) == 0:
+        print(f"Error: no ONNX models found in ../{cfg.misc.main_onnx_folder}; run export_onnx.py first")
+        quit()
+
+    num_threads = args.threads if args.threads is not None else 0
+    torch_ensemble = ensemble.Ensemble(get_models(device), device)
+    onnx_ensemble = ensemble.Ensemble([onnx_model.OnnxModel(path, num_threads) for path in onnx_paths], device)
+    print(f"Using {len(specs)} spectrograms from {args.input}")
+
+    # run each once to warm up, then time the second run
+    for model in [torch_ensemble, onnx_ensemble]:
+        model.get_predictions(specs[:cfg.infer.block_size])
+
+    start_time = time.time()
+    torch_predictions = torch_ensemble.get_predictions(specs)
+    torch_seconds = time.time() - start_time
+
+    start_time = time.time()
+    onnx_predictions = onnx_ensemble.get_predictions(specs)
+    onnx_seconds = time.time() - start_time
+
+    report(f"torch vs. onnx", torch_seconds, onnx_seconds, torch_predictions, onnx_predictions)
+    print(f"Throughput: torch={len(specs) / torch_seconds:.1f} specs/s, onnx={len(specs) / onnx_seconds:.1f} specs/s")
+
+# report how many segments the energy pre-screen would skip at several thresholds, and the effect on recall,
+# i.e. the fraction of ensemble scores >= min_score that would be lost because their segment was skipped
+def benchmark_prescreen(args):
+    device = 'cpu'
+    audio_obj = audio.Audio(device=device)
+    model = ensemble.Ensemble(get_models(device), device)
+    recording_paths = util.get_audio_files(args.input) if os.path.isdir(args.input) else [args.input]
+
+    activity, scores = [], []
+    for recording_path in recording_paths:
+        signal, rate = audio_obj.load(recording_path)
+        increment = cfg.audio.segment_len - cfg.infer.spec_overlap_seconds
+        offsets = np.arange(0, max(0, len(signal) / rate - cfg.audio.segment_len) + 1.0, increment).tolist()
+        raw_spectrograms = [0 for i in range(len(offsets))]
+        specs = audio_obj.get_spectrograms(offsets, raw_spectrograms=raw_spectrograms, from_blocks=cfg.infer.spec_from_blocks)
+
+        spec_array = np.zeros((len(specs), 1, cfg.audio.spec_height, cfg.audio.spec_width), dtype=np.float32)
+        for i, spec in enumerate(specs):
+            if spec is not None:
+                spec_array[i] = spec.reshape((1, cfg.audio.spec_height, cfg.audio.spec_width))
+
+        activity.append(audio.get_segment_activity(raw_spectrograms))
+        scores.append(model.get_predictions(spec_array) ** cfg.infer.score_exponent)
+
+    activity, scores = np.concatenate(activity), np.concatenate(scores)
+    detections = scores >= cfg.infer.min_score
+    print(f"{len(recording_paths)} recording(s), {len(scores)} segments, {detections.sum()} scores >= min_score={cfg.infer.min_score}")
+
+    for threshold in [2, 3, 4, 6, 8, 12]:
+        active = activity >= threshold
+        lost = detections[~active].sum()
+        recall = 1 - lost / max(1, detections.sum())
+        print(f"threshold={threshold}: skipped {100 * (1 - active.mean()):.1f}% of segments, lost {lost} detections, recall={recall:.4f}")
+
+# return the set of (recording, class, start, end) labels for a list of per-recording score matrices
+def get_label_set(score_list, offset_list):
+    label_set = set()
+    for i, (scores, offsets) in enumerate(zip(score_list, offset_list)):
+        scores, is_label = scores.copy(), np.zeros(scores.shape, dtype=bool)
+        columns = list(range(scores.shape[1]))
+        labels.mark_labels(scores, is_label, columns, cfg.infer.spec_overlap_seconds)
+        for column, start_time, end_time, score in labels.get_labels(scores, is_label, offsets, columns, True):
+            label_set.add((i, column, round(start_time, 2), round(end_time, 2)))
+
+    return label_set
+
+# compare the full ensemble with cascade mode for several values of cfg.infer.cascade_fraction,
+# on a recording or a folder of reference recordings, reporting the fraction of spectrograms escalated
+# to the full ensemble and the labels gained or lost
+def benchmark_cascade(args):
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    recording_paths = util.get_audio_files(args.input) if os.path.isdir(args.input) else [args.input]
+    audio_obj = audio.Audio(device=device)
+    spec_list = [audio_obj.get_recording_specs(recording_path) for recording_path in recording_paths]
+    offset_list = [np.arange(len(specs)) * (cfg.audio.segment_len - cfg.infer.spec_overlap_seconds) for specs in spec_list]
+    model = ensemble.Ensemble(get_models(device), device)
+    print(f"{len(recording_paths)} recording(s), {sum(len(specs) for specs in spec_list)} spectrograms, {len(model.models)} models")
+
+    start_time = time.time()
+    full_scores = [model.get_predictions(specs) ** cfg.infer.score_exponent for specs in spec_list]
+    full_seconds = time.time() - start_time
+    full_labels = get_label_set(full_scores, offset_list)
+
+    for fraction in [.25, .5, .75]:
+        model.set_cascade((fraction * cfg.infer.min_score) ** (1 / cfg.infer.score_exponent))
+        start_time = time.time()
+        cascade_scores = [model.get_predictions(specs) ** cfg.infer.score_exponent for specs in spec_list]
+        cascade_seconds = time.time() - start_time
+        cascade_labels = get_label_set(cascade_scores, offset_list)
+
+        print(f"fraction={fraction}: escalated {100 * model.num_escalated / model.num_screened:.1f}%, time {full_seconds:.2f}s -> {cascade_seconds:.2f}s, "
+              f"{len(full_labels)} labels, {len(full_labels - cascade_labels)} lost, {len(cascade_labels - full_labels)} added")
+
+# compare full overlap with cfg.infer.adaptive_overlap for several values of cfg.infer.adaptive_fraction, on a
+# recording or a folder of reference recordings, reporting the fraction of segments the models would run on
+# and the labels gained or lost; this uses the same segment selection as Analyzer._get_item_scores, but
+# with scores from the full run, since the models return the same scores for a segment either way
+def benchmark_adaptive(args):
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    recording_paths = util.get_audio_files(args.input) if os.path.isdir(args.input) else [args.input]
+    audio_obj = audio.Audio(device=device)
+    spec_list = [audio_obj.get_recording_specs(recording_path) for recording_path in recording_paths]
+    increment = cfg.audio.segment_len - cfg.infer.spec_overlap_seconds
+    offset_list = [np.arange(len(specs)) * increment for specs in spec_list]
+    model = ensemble.Ensemble(get_models(device), device)
+    print(f"{len(recording_paths)} recording(s), {sum(len(specs) for specs in spec_list)} spectrograms, {len(model.models)} models")
+
+    raw_scores = [model.get_predictions(specs) for specs in spec_list]
+    full_labels = get_label_set([scores ** cfg.infer.score_exponent for scores in raw_scores], offset_list)
+
+    k = max(1, int(round(cfg.audio.segment_len / increment)))
+    for fraction in [.25, .5, .75]:
+        threshold = (fraction * cfg.infer.min_score) ** (1 / cfg.infer.score_exponent)
+        adaptive_scores, num_run = [], 0
+        for scores in raw_scores:
+            coarse = (np.arange(len(scores)) % k == 0)
+            coarse[[0, -1]] = True
+            possible = (coarse & (scores >= threshold).any(axis=1)).astype(int)
+            fine = ~coarse & (np.convolve(possible, np.ones(2 * k - 1, dtype=int), mode='same') > 0)
+            adaptive_scores.append(np.where((coarse | fine)[:, np.newaxis], scores, 0) ** cfg.infer.score_exponent)
+            num_run += coarse.sum() + fine.sum()
+
+        adaptive_labels = get_label_set(adaptive_scores, offset_list)
+        num_segments = sum(len(scores) for scores in raw_scores)
+        print(f"fraction={fraction}: ran on {100 * num_run / num_segments:.1f}% of segments, "
+              f"{len(full_labels)} labels, {len(full_labels - adaptive_labels)} lost, {len(adaptive_labels - full_labels)} added")
+
+# compare MainModel.get_predictions with MainModel.get_strip_predictions for each model in the main checkpoint
+# folder that supports it; with one segment per strip the two should match to float precision, which checks
+# the mapping from segments to features, and a segment's features must not depend on distant frames; with
+# longer strips they differ near segment edges, as described in MainModel.get_strip_logits, so report the
+# differences in scores and labels as well as the elapsed time
+def benchmark_sliding(args):
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    audio_obj = audio.Audio(device=device)
+    specs = audio_obj.get_recording_specs(args.input)
+    offsets = (np.arange(len(specs)) * (cfg.audio.segment_len - cfg.infer.spec_overlap_seconds)).tolist()
+
+    print(f"{len(offsets)} spectrograms")
+    for model in get_models(device):
+        if not model.supports_strips():
+            print(f"{model.model_name}: not supported")
+            continue
+
+        model.get_predictions(specs[:cfg.infer.block_size], device) # warm up
+        start_time = time.time()
+        expected = model.get_predictions(specs, device)
+        old_seconds = time.time() - start_time
+
+        strips, strip_index, start_frames = audio_obj.get_strips(offsets, cfg.audio.segment_len)
+        max_diff = np.abs(model.get_strip_predictions(strips, strip_index, start_frames, device) - expected).max()
+        print(f"{model.model_name}: one segment per strip, max difference = {max_diff:.2e} ({'OK' if max_diff <= 1e-4 else 'FAILED'})")
+
+        # that doesn't check that features only depend on nearby frames, so also check that changing the last
+        # segment of a strip doesn't change the features of the first one
+        strip = torch.rand((1, 1, cfg.audio.spec_height, 3 * cfg.audio.spec_width), device=device)
+        changed = strip.clone()
+        changed[..., -cfg.audio.spec_width:] = 0
+        with torch.no_grad():
+            features, changed_features = model.base_model.forward_features(strip), model.base_model.forward_features(changed)
+
+        columns = features.shape[-1] // 3
+        local_diff = (features[..., :columns] - changed_features[..., :columns]).abs().max().item()
+        print(f"  locality: max change in first segment's features = {local_diff:.2e} ({'OK' if local_diff == 0 else 'FAILED'})")
+
+        for strip_seconds in [15, 60, 240]:
+            strips, strip_index, start_frames = audio_obj.get_strips(offsets, strip_seconds)
+            start_time = time.time()
+            actual = model.get_strip_predictions(strips, strip_index, start_frames, device)
+            new_seconds = time.time() - start_time
+
+            diff = np.abs(actual - expected)
+            expected_labels = get_label_set([expected ** cfg.infer.score_exponent], [np.array(offsets)])
+            actual_labels = get_label_set([actual ** cfg.infer.score_exponent], [np.array(offsets)])
+            print(f"  strip_seconds={strip_seconds}: time {old_seconds:.2f}s -> {new_seconds:.2f}s, mean difference = {diff.mean():.4f}, max = {diff.max():.4f}, "
+                  f"{len(expected_labels)} labels, {len(expected_labels - actual_labels)} lost, {len(actual_labels - expected_labels)} added")
+
+# compare core.decoder.Decoder with librosa.load, which was used before, on synthetic stereo recordings in
+# each format and sampling rate, reporting elapsed time and the maximum difference in the decoded signals;
+# each decoder is also checked on its own, and ones that can't read a format (e.g. ffmpeg if it's not installed)
+# are reported as unavailable
+def benchmark_decode(args):
+    import librosa
+    import soundfile as sf
+    from core import decoder
+
+    seconds = 120
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for rate in [16000, 24000, 32000, 44100, 48000]:
+            t = np.arange(seconds * rate) / rate
+            left = 0.1 * np.sin(2 * np.pi * 3000 * t) + 0.01 * rng.standard_normal(len(t))
+            signal = np.stack([left, 0.5 * left], axis=1).astype(np.float32)
+            for format in ['wav', 'flac', 'mp3']:
+                path = os.path.join(temp_dir, f'{rate}.{format}')
+                sf.write(path, signal, rate)
+
+                librosa.load(path, sr=cfg.audio.sampling_rate, mono=True) # warm up
+                start_time = time.time()
+                expected, _ = librosa.load(path, sr=cfg.audio.sampling_rate, mono=True)
+                old_seconds = time.time() - start_time
+
+                results = []
+                for name in ['soundfile', 'ffmpeg', 'librosa']:
+                    cfg.audio.decoders = [name]
+                    decoder_obj = decoder.Decoder()
+                    try:
+                        decoder_obj.load(path) # warm up, and create the resampler
+                        start_time = time.time()
+                        actual, _ = decoder_obj.load(path)
+                        new_seconds = time.time() - start_time
+                    except Exception:
+                        results.append(f"{name}=unavailable")
+                        continue
+
+                    length = min(len(expected), len(actual))
+                    max_diff = np.abs(expected[:length] - actual[:length]).max()
+                    status = 'OK' if max_diff <= args.tol and abs(len(expected) - len(actual)) <= 1 else 'FAILED'
+                    results.append(f"{name}={new_seconds:.3f}s ({old_seconds / new_seconds:.1f}x, max difference {max_diff:.1e} {status})")
+
+                print(f"{format} {rate}Hz: librosa.load={old_seconds:.3f}s, {', '.join(results)}")
+
+# compare decoding a span of a long recording (as for --start and --end) with decoding the whole recording and
+# slicing it, which is what the analyzer did before, for a synthetic recording in each format
+def benchmark_partial(args):
+    import soundfile as sf
+
+    seconds, offset, duration = 3600, 1800.5, 600
+    rng = np.random.default_rng(1)
+    rate = 44100
+    signal = (0.1 * rng.standard_normal(seconds * rate)).astype(np.float32)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for format in ['wav', 'flac']:
+            path = os.path.join(temp_dir, f'{rate}.{format}')
+            sf.write(path, signal, rate)
+            audio_obj = audio.Audio(device='cpu')
+
+            start_time = time.time()
+            whole, sr = audio_obj.load(path)
+            whole_seconds = time.time() - start_time
+            start = int(round(offset * sr))
+            expected = whole[start:start + int(round(duration * sr))]
+
+            start_time = time.time()
+            actual, _ = audio_obj.load(path, offset=offset, duration=duration)
+            part_seconds = time.time() - start_time
+
+            max_diff = np.abs(expected - actual).max() if len(expected) == len(actual) else np.inf
+            status = 'OK' if max_diff <= args.tol else 'FAILED'
+            print(f"{format}: whole={whole_seconds:.3f}s, {duration} seconds from {offset}={part_seconds:.3f}s ({whole_seconds / part_seconds:.1f}x), max difference {max_diff:.1e} {status}")
+
+# compare Audio.load on a stereo recording, which picks a channel from the first check_seconds and then decodes
+# just that channel, with decoding both channels and picking one afterwards, which is what it did before;
+# the noisy channel switches halfway through, so loading a span from the second half (as for --start and --end,
+# or a stream window) must still use the channel chosen from the start of the recording
+def benchmark_channel(args):
+    import soundfile as sf
+    from core import decoder
+
+    seconds, rate = 600, 44100
+    offset, duration = 310.3, 60
+    rng = np.random.default_rng(1)
+    t = np.arange(seconds * rate) / rate
+    clean = 0.1 * np.sin(2 * np.pi * 3000 * t)
+    noisy = clean + 0.3 * rng.standard_normal(len(t))
+    half = len(t) // 2
+    left = np.concatenate([noisy[:half], clean[half:]])
+    right = np.concatenate([clean[:half], noisy[half:]])
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for format in ['wav', 'flac']:
+            path = os.path.join(temp_dir, f'stereo.{format}')
+            sf.write(path, np.stack([left, right], axis=1).astype(np.float32), rate)
+            audio_obj = audio.Audio(device='cpu')
+
+            start_time = time.time()
+            stereo, sr = decoder.Decoder().load(path, mono=False)
+            expected = stereo[audio_obj._choose_channel(stereo)]
+            old_seconds = time.time() - start_time
+
+            start_time = time.time()
+            actual, _ = audio_obj.load(path)
+            new_seconds = time.time() - start_time
+            channel = audio_obj.channel
+
+            max_diff = np.abs(expected - actual).max() if len(expected) == len(actual) else np.inf
+            status = 'OK' if max_diff <= args.tol else 'FAILED'
+            print(f"{format}: decode both channels={old_seconds:.3f}s, check then decode one={new_seconds:.3f}s ({old_seconds / new_seconds:.1f}x), channel={channel}, max difference {max_diff:.1e} {status}")
+
+            start = int(round(offset * sr))
+            expected = expected[start:start + int(round(duration * sr))]
+            actual, _ = audio_obj.load(path, offset=offset, duration=duration)
+            max_diff = np.abs(expected - actual).max() if len(expected) == len(actual) else np.inf
+            status = 'OK' if audio_obj.channel == channel and max_diff <= args.tol else 'FAILED'
+            print(f"{format}: {duration} seconds from {offset}: channel={audio_obj.channel}, max difference {max_diff:.1e} {status}")
+
+# compare the spectrograms and labels from the decode and spectrogram stages of analyze.Analyzer with a fractional
+# --start, without and with streaming (in windows of 31.3 seconds, so they start at fractional times too), with
+# those from decoding the whole recording and computing the spectrograms at the same times in the recording;
+# this is done for the input recording with the given start and end, and for a 96-second stereo recording made
+# from it at 44.1 kHz, with a start and end in the second half and the noisy channel switching halfway, which
+# checks the resampled edges of a partial decode, and that it uses the channel chosen for the whole recording
+def benchmark_start(args):
+    import analyze
+    import soundfile as sf
+    import soxr
+
+    device = 'cpu'
+    model = ensemble.Ensemble(get_models(device), device)
+    audio_obj = audio.Audio(device=device)
+    cfg.audio.spec_block_seconds = 31.3
+    with tempfile.TemporaryDirectory() as temp_dir:
+        signal, rate = audio_obj.load(args.input)
+        stereo_rate = 44100
+        clean = soxr.resample(np.tile(signal, int(np.ceil(96 * rate / len(signal))))[:96 * rate], rate, stereo_rate)
+        noisy = clean + 0.3 * np.random.default_rng(1).standard_normal(len(clean))
+        half = len(clean) // 2
+        stereo_path = os.path.join(temp_dir, 'stereo.flac')
+        sf.write(stereo_path, np.stack([np.concatenate([noisy[:half], clean[half:]]), np.concatenate([clean[:half], noisy[half:]])], axis=1), stereo_rate)
+
+        for path, start, end in [(args.input, args.start, args.end), (stereo_path, '50.7', '1:10')]:
+            audio_obj.load(path)
+            for stream in [False, True]:
+                cfg.infer.stream = stream
+                analyzer = analyze.Analyzer(path, temp_dir, start, end, None, None, None, None, None, False, 1, args.overlap, device)
+                analyzer.decode_audio, analyzer.audio = audio.Audio(device=device), audio.Audio(device=device)
+                analyzer.check_frequency, analyzer.cache, analyzer.handler_resources, analyzer.use_strips = False, None, set(), False
+
+                offsets, spec_list = [], []
+                for item in analyzer._decode(path):
+                    analyzer._get_specs(item)
+                    offsets += item.offsets
+                    spec_list.append(item.specs)
+
+                actual = np.concatenate(spec_list)
+                expected = audio.get_spec_array(audio_obj.get_spectrograms(offsets), cfg.audio.spec_height)
+                max_diff = np.abs(expected - actual).max()
+
+                expected_labels = get_label_set([model.get_predictions(expected) ** cfg.infer.score_exponent], [np.array(offsets)])
+                actual_labels = get_label_set([model.get_predictions(actual) ** cfg.infer.score_exponent], [np.array(offsets)])
+                status = 'OK' if max_diff <= args.tol and expected_labels == actual_labels and analyzer.decode_audio.channel == audio_obj.channel else 'FAILED'
+                print(f"{Path(path).name}, start={start}, end={end}, stream={stream}: channel={analyzer.decode_audio.channel}, {len(offsets)} segments from {offsets[0]:.2f} to {offsets[-1]:.2f}, "
+                      f"max difference {max_diff:.1e}, {len(expected_labels)} labels, {len(expected_labels - actual_labels)} lost, {len(actual_labels - expected_labels)} added {status}")
+
+# compare spectrograms sliced from blocks (cfg.infer.spec_from_blocks) with those computed per segment,
+# both before normalization (mel and low band) and after it, for the input recording at the given overlap
+def benchmark_blocks(args):
+    audio_obj = audio.Audio(device='cpu')
+    signal, rate = audio_obj.load(args.input)
+    seconds = len(signal) / rate
+    increment = max(0.5, cfg.audio.segment_len - args.overlap)
+    offsets = np.arange(0, max(0, seconds - cfg.audio.segment_len) + 1.0, increment).tolist()
+
+    results = []
+    for from_blocks in [False, True]:
+        audio_obj.get_spectrograms(offsets, from_blocks=from_blocks) # warm up
+        raw_spectrograms, low_band_specs = [0 for offset in offsets], [0 for offset in offsets]
+        start_time = time.time()
+        specs = audio_obj.get_spectrograms(offsets, raw_spectrograms=raw_spectrograms, from_blocks=from_blocks, low_band_specs=low_band_specs)
+        results.append((time.time() - start_time, specs, raw_spectrograms, low_band_specs))
+
+    (old_seconds, *old_lists), (new_seconds, *new_lists) = results
+    max_diffs = [max(np.abs(old - new).max() for old, new in zip(old_list, new_list) if old is not None) for old_list, new_list in zip(old_lists, new_lists)]
+    status = 'OK' if max(max_diffs) <= args.tol else 'FAILED'
+    print(f"{len(offsets)} segments: per segment={old_seconds:.3f}s, blocks={new_seconds:.3f}s ({old_seconds / new_seconds:.1f}x)")
+    print(f"max difference normalized={max_diffs[0]:.1e}, raw={max_diffs[1]:.1e}, low band={max_diffs[2]:.1e} {status}")
+
+# generate labels for the given columns using the per-class loops that were previously in Analyzer._analyze_file
+def get_labels_with_loops(scores, is_label, offsets, columns, overlap, merge):
+    label_list = []
+    for column in columns:
+        class_scores = scores[:, column]
+        class_labels = is_label[:, column]
+        for i in range(len(class_scores)):
+            if class_scores[i] < cfg.infer.min_score or class_scores[i] == 0:
+                continue
+
+            class_labels[i] = True
+
+        if cfg.infer.lower_min_if_confirmed and cfg.infer.min_score > 0:
+            seconds = 0
+            raised_min_score = cfg.infer.min_score + cfg.infer.raise_min_to_confirm * (1 - cfg.infer.min_score)
+            for i in range(len(class_labels)):
+                if class_labels[i] and class_scores[i] >= raised_min_score:
+                    if i > 0 and class_labels[i - 1]:
+                        seconds += overlap
+                    else:
+                        seconds += cfg.audio.segment_len
+
+            if seconds > cfg.infer.confirmed_if_seconds:
+                lowered_min_score = cfg.infer.lower_min_factor * cfg.infer.min_score
+                for i in range(len(class_scores)):
+                    if not class_labels[i] and class_scores[i] >= lowered_min_score:
+                        class_labels[i] = True
+                        class_scores[i] = cfg.infer.min_score
+
+        prev_label = None
+        for i in range(len(class_scores)):
+            if class_labels[i]:
+                end_time = offsets[i] + cfg.audio.segment_len
+                if merge and prev_label != None and prev_label[2] >= offsets[i]:
+                    prev_label[2] = end_time
+                    prev_label[3] = max(class_scores[i], prev_label[3])
+                else:
+                    prev_label = [column, offsets[i], end_time, class_scores[i]]
+                    label_list.append(prev_label)
+
+    return label_list
+
+# compare the label engine in core/labels.py with the per-class loops it replaced, using random scores
+# for a long recording where many classes have detections; output must match exactly
+def benchmark_labels(args):
+    rng = np.random.default_rng(1)
+    num_segments, num_classes = args.segments, args.classes
+    offsets = np.arange(0, num_segments * 1.5, 1.5).tolist()
+
+    # smooth random scores over time so there are runs of labels, and make some classes much denser than others
+    scores = rng.random((num_segments, num_classes), dtype=np.float32) ** rng.uniform(.5, 8, num_classes).astype(np.float32)
+    scores = ((scores + np.roll(scores, 1, axis=0)) / 2).astype(np.float32)
+    columns = list(range(num_classes))
+    print(f"{num_segments} segments, {num_classes} classes, {(scores >= cfg.infer.min_score).mean() * 100:.1f}% of scores >= min_score")
+
+    # warm up both code paths, so one-time overhead isn't included in the first timed case
+    for merge in [True, False]:
+        get_labels_with_loops(scores[:100].copy(), np.zeros((100, num_classes), dtype=bool), offsets[:100], columns, args.overlap, merge)
+        warm_scores, warm_is_label = scores[:100].copy(), np.zeros((100, num_classes), dtype=bool)
+        labels.mark_labels(warm_scores, warm_is_label, columns, args.overlap)
+        labels.get_labels(warm_scores, warm_is_label, offsets[:100], columns, merge)
+
+    for merge in [True, False]:
+        old_scores, old_is_label = scores.copy(), np.zeros(scores.shape, dtype=bool)
+        start_time = time.time()
+        old_labels = get_labels_with_loops(old_scores, old_is_label, offsets, columns, args.overlap, merge)
+        old_seconds = time.time() - start_time
+
+        new_scores, new_is_label = scores.copy(), np.zeros(scores.shape, dtype=bool)
+        start_time = time.time()
+        labels.mark_labels(new_scores, new_is_label, columns, args.overlap)
+        new_labels = labels.get_labels(new_scores, new_is_label, offsets, columns, merge)
+        new_seconds = time.time() - start_time
+
+        old_text = ''.join([f'{label[1]:.2f}\t{label[2]:.2f}\t{label[0]};{label[3]:.3f}\n' for label in old_labels])
+        new_text = ''.join([f'{label[1]:.2f}\t{label[2]:.2f}\t{label[0]};{label[3]:.3f}\n' for label in new_labels])
+        print(f"merge={merge}: old={old_seconds:.3f}s, new={new_seconds:.3f}s, speedup={old_seconds / new_seconds:.1f}x, {len(new_labels)} labels, identical output={old_text == new_text}")
+
+if __name__ == '__main__':
+    modes = {
+        'blocks': benchmark_blocks,
+        'ensemble': benchmark_ensemble,
+        'filters': benchmark_filters,
+        'labels': benchmark_labels,
+        'onnx': benchmark_onnx,
+        'prescreen': benchmark_prescreen,
+        'cascade': benchmark_cascade,
+        'adaptive': benchmark_adaptive,
+        'sliding': benchmark_sliding,
+        'decode': benchmark_decode,
+        'partial': benchmark_partial,
+        'channel': benchmark_channel,
+        'start': benchmark_start,
+    }
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', type=str, choices=list(modes.keys()), help='Benchmark to run.')
+    parser.add_argument('-i', '--input', type=str, default='../recordings/CommonYellowthroat.mp3', help='Recording used to generate spectrograms (or a folder of recordings for the prescreen, cascade and adaptive benchmarks). Default = ../recordings/CommonYellowthroat.mp3.')
+    parser.add_argument('--classes', type=int, default=300, help='Number of classes for labels benchmark. Default = 300.')
+    parser.add_argument('-e', '--end', type=str, default='', help='Optional end time for start benchmark, as for analyze.py.')
+    parser.add_argument('--overlap', type=float, default=cfg.infer.spec_overlap_seconds, help=f'Overlap seconds for blocks, labels and start benchmarks. Default = {cfg.infer.spec_overlap_seconds}.')
+    parser.add_argument('--segments', type=int, default=20000, help='Number of segments for labels benchmark. Default = 20000.')
+    parser.add_argument('-s', '--start', type=str, default='1.3', help='Start time for start benchmark, as for analyze.py. Default = 1.3.')
+    parser.add_argument('--tol', type=float, default=1e-5, help='Maximum allowed difference in spectrograms or decoded signals for blocks, decode, partial, channel and start benchmarks. Default = 1e-5.')
+    parser.add_argument('--threads', type=int, default=None, help='Number of threads used by torch (and ONNX Runtime) on CPU. Default = library default.')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    modes[args.mode](args)
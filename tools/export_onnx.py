@@ -0,0 +1,48 @@
+# Export the main ensemble checkpoints and the low band checkpoint to ONNX, for use with "analyze.py --backend onnx".
+# Each exported model is checked against the PyTorch version, using spectrograms from the given recording,
+# and the maximum difference in sigmoid (or softmax for the low band model) outputs is reported.
+
+import argparse
+import glob
+import inspect
+import os
+from pathlib import Path
+import sys
+
+import numpy as np
+import torch
+
+# this is necessary before importing from a peer directory
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from core import audio
+from core import cfg
+from model import main_model
+from model import onnx_model
+
+def export(ckpt_path, output_path, specs, use_softmax, tolerance):
+    model = main_model.MainModel.load_from_checkpoint(ckpt_path, map_location=torch.device('cpu'))
+    onnx_model.export(model, output_path, specs.shape[2])
+
+    expected = model.get_predictions(specs, 'cpu', use_softmax=use_softmax)
+    actual = onnx_model.OnnxModel(output_path).get_predictions(specs, 'cpu', use_softmax=use_softmax)
+    max_diff = np.abs(expected - actual).max()
+    status = 'OK' if max_diff <= tolerance else 'FAILED'
+    print(f"Exported {ckpt_path} to {output_path}: max difference = {max_diff:.2e} ({status})")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, default='../recordings/CommonYellowthroat.mp3', help='Recording used for the parity check. Default = ../recordings/CommonYellowthroat.mp3.')
+    parser.add_argument('--tol', type=float, default=1e-4, help='Maximum allowed difference in predictions. Default = 1e-4.')
+    args = parser.parse_args()
+
+    specs, low_band_specs = audio.Audio(device='cpu').get_recording_specs(args.input, increment=cfg.audio.segment_len, low_band=True)
+
+    output_dir = os.path.join('..', cfg.misc.main_onnx_folder)
+    os.makedirs(output_dir, exist_ok=True)
+    for ckpt_path in sorted(glob.glob(os.path.join('..', cfg.misc.main_ckpt_folder, '*.ckpt'))):
+        export(ckpt_path, os.path.join(output_dir, f'{Path(ckpt_path).stem}.onnx'), specs, False, args.tol)
+
+    export(os.path.join('..', cfg.misc.low_band_ckpt_path), os.path.join('..', cfg.misc.low_band_onnx_path), low_band_specs, True, args.tol)
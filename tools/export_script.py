@@ -0,0 +1,56 @@
+# Convert the main ensemble checkpoints and the low band checkpoint to frozen TorchScript, for use with
+# "analyze.py --backend script", which avoids the cost of loading Lightning checkpoints at startup.
+# Each converted model is checked against the original, using spectrograms from the given recording,
+# and the load time of both is reported.
+
+import argparse
+import glob
+import inspect
+import os
+from pathlib import Path
+import sys
+import time
+
+import numpy as np
+import torch
+
+# this is necessary before importing from a peer directory
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from core import audio
+from core import cfg
+from model import main_model
+from model import script_model
+
+def export(ckpt_path, output_path, specs, use_softmax, tolerance):
+    start_time = time.time()
+    model = main_model.MainModel.load_from_checkpoint(ckpt_path, map_location=torch.device('cpu'))
+    ckpt_seconds = time.time() - start_time
+    script_model.export(model, output_path, specs.shape[2])
+
+    start_time = time.time()
+    converted = script_model.ScriptModel(output_path, 'cpu')
+    script_seconds = time.time() - start_time
+
+    expected = model.get_predictions(specs, 'cpu', use_softmax=use_softmax)
+    actual = converted.get_predictions(specs, 'cpu', use_softmax=use_softmax)
+    max_diff = np.abs(expected - actual).max()
+    status = 'OK' if max_diff <= tolerance else 'FAILED'
+    print(f"Converted {ckpt_path} to {output_path}: load time {ckpt_seconds:.2f}s -> {script_seconds:.2f}s, max difference = {max_diff:.2e} ({status})")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, default='../recordings/CommonYellowthroat.mp3', help='Recording used for the parity check. Default = ../recordings/CommonYellowthroat.mp3.')
+    parser.add_argument('--tol', type=float, default=1e-4, help='Maximum allowed difference in predictions. Default = 1e-4.')
+    args = parser.parse_args()
+
+    specs, low_band_specs = audio.Audio(device='cpu').get_recording_specs(args.input, increment=cfg.audio.segment_len, low_band=True)
+
+    output_dir = os.path.join('..', cfg.misc.main_script_folder)
+    os.makedirs(output_dir, exist_ok=True)
+    for ckpt_path in sorted(glob.glob(os.path.join('..', cfg.misc.main_ckpt_folder, '*.ckpt'))):
+        export(ckpt_path, os.path.join(output_dir, f'{Path(ckpt_path).stem}.pt'), specs, False, args.tol)
+
+    export(os.path.join('..', cfg.misc.low_band_ckpt_path), os.path.join('..', cfg.misc.low_band_script_path), low_band_specs, True, args.tol)
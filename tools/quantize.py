@@ -0,0 +1,117 @@
+# Create int8 versions of the ONNX models created by export_onnx.py, for use with "analyze.py --backend int8".
+# Spectrograms from a folder of recordings are split into a calibration set, used to choose the quantization
+# ranges, and an evaluation set, used to compare the int8 and float32 ensembles. The comparison is written
+# to a CSV file with per-class score drift, and the throughput of both ensembles is reported.
+
+import argparse
+import glob
+import inspect
+import os
+from pathlib import Path
+import sys
+import time
+
+import numpy as np
+import onnx
+from onnxruntime import quantization
+import pandas as pd
+
+# this is necessary before importing from a peer directory
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from core import audio
+from core import cfg
+from core import util
+from model import ensemble
+from model import onnx_model
+
+# feed calibration spectrograms to the quantizer one block at a time
+class SpecReader(quantization.CalibrationDataReader):
+    def __init__(self, specs, input_name, block_size=32):
+        self.blocks = iter([{input_name: specs[i:i + block_size]} for i in range(0, len(specs), block_size)])
+
+    def get_next(self):
+        return next(self.blocks, None)
+
+# return a random sample of spectrograms from the recordings in the given folder
+def get_specs(input_path, max_specs, seed):
+    audio_obj = audio.Audio(device='cpu')
+    spec_arrays = [audio_obj.get_recording_specs(recording_path) for recording_path in util.get_audio_files(input_path)]
+    spec_array = np.concatenate([specs for specs in spec_arrays if specs is not None])
+
+    rng = np.random.default_rng(seed)
+    return spec_array[rng.permutation(len(spec_array))[:max_specs]]
+
+# quantize weights and activations to int8, keeping the class metadata
+def quantize(input_path, output_path, calibration_specs):
+    prepared_path = f'{output_path}.prep'
+    quantization.quant_pre_process(input_path, prepared_path)
+
+    input_name = onnx.load(prepared_path).graph.input[0].name
+    quantization.quantize_static(prepared_path, output_path, SpecReader(calibration_specs, input_name),
+                                 quant_format=quantization.QuantFormat.QDQ, per_channel=True,
+                                 activation_type=quantization.QuantType.QUInt8, weight_type=quantization.QuantType.QInt8,
+                                 calibrate_method=quantization.CalibrationMethod.MinMax)
+    os.remove(prepared_path)
+
+    source, target = onnx.load(input_path), onnx.load(output_path)
+    for entry in source.metadata_props:
+        target.metadata_props.add().CopyFrom(entry)
+
+    onnx.save(target, output_path)
+
+# return ensemble predictions and elapsed seconds
+def get_predictions(model_paths, specs, num_threads):
+    model = ensemble.Ensemble([onnx_model.OnnxModel(path, num_threads) for path in model_paths], 'cpu')
+    model.get_predictions(specs[:cfg.infer.block_size]) # warm up
+
+    start_time = time.time()
+    predictions = model.get_predictions(specs)
+    return predictions, time.time() - start_time
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, default='../recordings', help='Folder of recordings used for calibration and evaluation. Default = ../recordings.')
+    parser.add_argument('-n', '--num_specs', type=int, default=1000, help='Maximum number of spectrograms to use, half for calibration and half for evaluation. Default = 1000.')
+    parser.add_argument('-o', '--output', type=str, default='drift.csv', help='Output CSV with per-class score drift. Default = drift.csv.')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for sampling spectrograms. Default = 1.')
+    parser.add_argument('--threads', type=int, default=0, help='Threads per model when measuring throughput (0 = ONNX Runtime default). Default = 0.')
+    args = parser.parse_args()
+
+    float_paths = sorted(glob.glob(os.path.join('..', cfg.misc.main_onnx_folder, '*.onnx')))
+    if len(float_paths) == 0:
+        print(f"Error: no ONNX models found in ../{cfg.misc.main_onnx_folder}; run export_onnx.py first")
+        quit()
+
+    specs = get_specs(args.input, args.num_specs, args.seed)
+    calibration_specs, eval_specs = specs[:len(specs) // 2], specs[len(specs) // 2:]
+    print(f"Using {len(calibration_specs)} spectrograms for calibration and {len(eval_specs)} for evaluation")
+
+    output_dir = os.path.join('..', cfg.misc.main_int8_folder)
+    os.makedirs(output_dir, exist_ok=True)
+    int8_paths = []
+    for float_path in float_paths:
+        int8_path = os.path.join(output_dir, Path(float_path).name)
+        quantize(float_path, int8_path, calibration_specs)
+        int8_paths.append(int8_path)
+        print(f"Quantized {float_path} to {int8_path}")
+
+    float_predictions, float_seconds = get_predictions(float_paths, eval_specs, args.threads)
+    int8_predictions, int8_seconds = get_predictions(int8_paths, eval_specs, args.threads)
+    print(f"Throughput: float32={len(eval_specs) / float_seconds:.1f} specs/s, int8={len(eval_specs) / int8_seconds:.1f} specs/s, speedup={float_seconds / int8_seconds:.2f}x")
+
+    # per-class drift, including how often a score moves across min_score after score_exponent is applied
+    float_scores = float_predictions ** cfg.infer.score_exponent
+    int8_scores = int8_predictions ** cfg.infer.score_exponent
+    diff = np.abs(float_scores - int8_scores)
+    crossed = (float_scores >= cfg.infer.min_score) != (int8_scores >= cfg.infer.min_score)
+    class_names = onnx_model.OnnxModel(float_paths[0]).train_class_names
+    df = pd.DataFrame({'class': class_names, 'mean_drift': diff.mean(axis=0), 'max_drift': diff.max(axis=0),
+                       'threshold_changes': crossed.sum(axis=0), 'float_labels': (float_scores >= cfg.infer.min_score).sum(axis=0)})
+    df = df.sort_values('max_drift', ascending=False)
+    df.to_csv(args.output, index=False, float_format='%.4f')
+
+    print(f"Score drift: mean={diff.mean():.4f}, max={diff.max():.4f}, {crossed.sum()} of {crossed.size} scores crossed min_score={cfg.infer.min_score}")
+    print(f"Per-class drift written to {args.output}")